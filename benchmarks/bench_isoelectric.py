@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+"""bench_isoelectric.py: Time the batched ProMoST isoelectric point solver against the scalar one."""
+
+import os
+import sys
+import random
+import timeit
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) #mercat of this checkout
+
+from mercat.metrics import kmer_matrix, predict_isoelectric_point_ProMoST, predict_isoelectric_point_ProMoST_kmers
+
+amino_acids = 'ACDEFGHIKLMNPQRSTVWY'
+
+
+def random_kmers(n, kmer, seed=0):
+    rng = random.Random(seed)
+    return [''.join(rng.choice(amino_acids) for _ in range(kmer)) for _ in range(n)]
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark predict_isoelectric_point_ProMoST_batch')
+    parser.add_argument('-n', type=int, default=1000000, help='number of k-mers [default = 1M]')
+    parser.add_argument('-k', type=int, default=5, help='kmer length [default = 5]')
+    parser.add_argument('--check', type=int, default=10000, help='k-mers also run through the scalar solver [default = 10000]')
+    args = parser.parse_args()
+
+    kmers = random_kmers(args.n, args.k)
+    mat = kmer_matrix(kmers)
+
+    start_time = timeit.default_timer()
+    pI = predict_isoelectric_point_ProMoST_kmers(mat)
+    batch_time = timeit.default_timer() - start_time
+    print("batch solver: %d k-mers in %.2f secs (%.0f k-mers/s)" % (args.n, batch_time, args.n / batch_time))
+
+    ncheck = min(args.check, args.n)
+    if ncheck:
+        start_time = timeit.default_timer()
+        ref = [predict_isoelectric_point_ProMoST(k) for k in kmers[:ncheck]]
+        scalar_time = timeit.default_timer() - start_time
+        mismatches = sum(1 for a, b in zip(ref, pI[:ncheck].tolist()) if a != b)
+        print("scalar solver: %d k-mers in %.2f secs (%.0f k-mers/s), %d mismatches" % (
+            ncheck, scalar_time, ncheck / scalar_time, mismatches))
+        if mismatches: raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
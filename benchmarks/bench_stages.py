@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+
+"""bench_stages.py: Time every stage of a mercat run on synthetic inputs and check for regressions."""
+
+import os
+import sys
+import json
+import shutil
+import timeit
+import platform
+import tempfile
+import threading
+import psutil
+import numpy as np
+from argparse import ArgumentParser
+
+#the benchmarks run from a checkout of the repository, mercat need not be installed
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_root)
+
+from synthetic import datasets, dataset_file, default_seed
+
+from mercat.mercat import select_backend, batch_sequences, calculateKmerCountBatch, merge_counts, summarize_counts
+from mercat.Chunker import mercat_partitioner
+from mercat.seqreader import read_records
+from mercat.tables import table_metadata, write_count_table
+from mercat.metrics import PropertyCache, kmer_matrix, predict_isoelectric_point_ProMoST_kmers
+from mercat.metrics import mercat_compute_alpha_beta_diversity, mercat_scatter_plots, mercat_stackedbar_plots
+
+
+class PeakRSS(object):
+    '''Highest resident set size of this process while the with block runs, sampled every interval seconds'''
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.process = psutil.Process()
+
+    def __enter__(self):
+        self.start = self.peak = self.process.memory_info().rss
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.sample)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def sample(self):
+        while not self.stop.wait(self.interval):
+            self.peak = max(self.peak, self.process.memory_info().rss)
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.thread.join()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+
+
+def import_stage_modules():
+    '''The stages import pandas, scikit-bio and plotly on first use, that is not part of their time'''
+    import pandas
+    import skbio.diversity
+    import plotly.graph_objs
+
+
+def time_stage(func, repeat):
+    '''(result, best wall time, peak RSS, largest RSS growth over the start of a run) of repeat runs of func'''
+    times = []
+    peak = growth = 0
+    for _ in range(repeat):
+        with PeakRSS() as rss:
+            start_time = timeit.default_timer()
+            result = func()
+            times.append(timeit.default_timer() - start_time)
+        peak = max(peak, rss.peak)
+        growth = max(growth, rss.peak - rss.start)
+    return result, min(times), peak, growth
+
+
+def run_stages(path, kmer, is_protein, is_fastq, out_dir, chunk_bytes, prune_kmer, repeat):
+    '''
+    The stages of mercat_sample on one input, in order, each timed on its own:
+    parse, partition (Chunker), count (per batch), merge (parent merge of the
+    batch tables), summary, isoelectric (protein only), write (the summary
+    table), diversity and plots. Yields (stage, secs, peak RSS, RSS growth, items, error).
+    '''
+    np_string = "protein" if is_protein else "nucleotide"
+    kmerstring = str(kmer) + "-mers"
+    backend = select_backend('auto', kmer, is_protein)
+    base = os.path.join(out_dir, "bench_" + np_string)
+    state = dict()
+
+    def parse():
+        state['seqs'] = [cseq for _, cseq in read_records(path, is_fastq)]
+        return len(state['seqs'])
+
+    def partition():
+        return len(mercat_partitioner(path, chunk_bytes, is_fastq))
+
+    def count():
+        state['tables'] = [calculateKmerCountBatch(batch, kmer, backend) for batch in batch_sequences(state['seqs'], 1 << 20)]
+        return len(state['tables'])
+
+    def merge():
+        state['table'] = merge_counts(state['tables'], backend)
+        return len(state['table'][0]) if backend == 'numpy' else len(state['table'])
+
+    def summary():
+        state['df'], num_kmers = summarize_counts(state['table'], backend, kmer, prune_kmer, is_protein,
+                                                  PropertyCache() if is_protein else None)
+        return len(state['df'])
+
+    def isoelectric():
+        return len(predict_isoelectric_point_ProMoST_kmers(kmer_matrix(state['df'].index.values)))
+
+    def write():
+        write_count_table(state['df'], base + "_summary", 'csv', kmerstring, table_metadata(kmer, np_string, prune_kmer, "bench"))
+        return len(state['df'])
+
+    def diversity():
+        mercat_compute_alpha_beta_diversity(state['df'].Count.values.astype(int), base)
+        return len(state['df'])
+
+    def plots():
+        df10 = state['df'].nlargest(10, 'Count')
+        for xlab in (['PI', 'MW', 'Hydro'] if is_protein else ['GC_Percent', 'AT_Percent']):
+            mercat_scatter_plots("bench", xlab, df10, kmerstring, out_dir)
+        mercat_stackedbar_plots("bench", {"bench": [df10, state['df'].Count.sum()]}, 'Count', kmerstring, out_dir)
+        return 1
+
+    stages = [('parse', parse), ('partition', partition), ('count', count), ('merge', merge), ('summary', summary)]
+    if is_protein: stages.append(('isoelectric', isoelectric))
+    stages += [('write', write), ('diversity', diversity), ('plots', plots)]
+    for name, func in stages:
+        try:
+            items, secs, peak, growth = time_stage(func, repeat)
+            yield name, secs, peak, growth, items, None
+        except Exception as e:
+            #the stages after a failed one still run, the benchmark then fails as a whole
+            yield name, None, None, None, None, type(e).__name__ + ": " + (str(e).strip().splitlines() or [""])[0]
+            if name in ('parse', 'count', 'merge', 'summary'): return
+
+
+def input_bases(path, is_fastq):
+    return sum(len(cseq) for _, cseq in read_records(path, is_fastq))
+
+
+def check_regressions(results, baseline, max_slowdown, max_rss_growth, min_secs):
+    '''Stages that got slower than max_slowdown times, or whose peak RSS grew more than max_rss_growth times, the baseline'''
+    before = dict(((r['dataset'], r['size'], r['k'], r['stage']), r) for r in baseline['results'])
+    regressions = []
+    for r in results:
+        b = before.get((r['dataset'], r['size'], r['k'], r['stage']))
+        if b is None or r['secs'] is None or b['secs'] is None: continue
+        if r['secs'] > max(b['secs'], min_secs) * max_slowdown:
+            regressions.append("%s %s k=%d %s: %.3f secs, baseline %.3f secs" % (r['dataset'], r['size'], r['k'], r['stage'], r['secs'], b['secs']))
+        if r['peak_rss'] > b['peak_rss'] * max_rss_growth:
+            regressions.append("%s %s k=%d %s: peak RSS %.1f MB, baseline %.1f MB" % (
+                r['dataset'], r['size'], r['k'], r['stage'], r['peak_rss'] / 1e6, b['peak_rss'] / 1e6))
+    return regressions
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark the stages of mercat on synthetic inputs')
+    parser.add_argument('--datasets', type=str, default=','.join(sorted(datasets)), help='comma separated datasets [default = all]')
+    parser.add_argument('--sizes', type=str, default='1,8', help='comma separated input sizes in MB [default = 1,8]')
+    parser.add_argument('-k', type=str, default='4,8,12', help='comma separated nucleotide kmer lengths [default = 4,8,12]')
+    parser.add_argument('--protein-k', type=str, default='3,5', help='comma separated protein kmer lengths [default = 3,5]')
+    parser.add_argument('-c', type=int, default=10, help='minimum kmer count of the summary [default = 10]')
+    parser.add_argument('-r', type=int, default=1, help='runs per stage, the best one counts [default = 1]')
+    parser.add_argument('--seed', type=int, default=default_seed, help='random seed of the inputs [default = %d]' % default_seed)
+    parser.add_argument('--data', type=str, required=False, help='folder to keep the generated inputs in [default = a temporary folder]')
+    parser.add_argument('--json', type=str, required=False, help='write the results to this JSON file')
+    parser.add_argument('--baseline', type=str, required=False, help='JSON results of an earlier run to check for regressions')
+    parser.add_argument('--max-slowdown', type=float, default=1.25, help='allowed time of a stage relative to the baseline [default = 1.25]')
+    parser.add_argument('--max-rss-growth', type=float, default=1.25, help='allowed peak RSS of a stage relative to the baseline [default = 1.25]')
+    parser.add_argument('--min-secs', type=float, default=0.05, help='baseline times below this count as this, near-instant stages are all noise [default = 0.05]')
+    args = parser.parse_args()
+
+    import_stage_modules()
+    work_dir = tempfile.mkdtemp(prefix="mercat_bench_")
+    data_dir = args.data or work_dir
+    if not os.path.isdir(data_dir): os.makedirs(data_dir)
+
+    results = []
+    try:
+        for name in args.datasets.split(','):
+            _, _, is_protein = datasets[name]
+            kmers = [int(k) for k in (args.protein_k if is_protein else args.k).split(',')]
+            for mb in args.sizes.split(','):
+                nbytes = int(float(mb) * 1024 * 1024)
+                path = dataset_file(data_dir, name, nbytes, args.seed)
+                is_fastq = path.endswith('.fq')
+                nbases = input_bases(path, is_fastq)
+                for kmer in kmers:
+                    out_dir = os.path.join(work_dir, "out")
+                    if os.path.exists(out_dir): shutil.rmtree(out_dir)
+                    os.makedirs(out_dir)
+                    for stage, secs, peak, growth, items, error in run_stages(path, kmer, is_protein, is_fastq, out_dir,
+                                                                      max(nbytes // 8, 1), args.c, args.r):
+                        results.append({'dataset': name, 'size': mb + "MB", 'k': kmer, 'stage': stage, 'bases': nbases,
+                                        'secs': secs, 'bases_per_sec': nbases / secs if secs else None,
+                                        'peak_rss': peak, 'rss_growth': growth, 'items': items, 'error': error})
+                        if error: print("%-8s %6s k=%-2d %-12s FAILED %s" % (name, mb + "MB", kmer, stage, error))
+                        else: print("%-8s %6s k=%-2d %-12s %8.3f secs %12.0f bases/s %8.1f MB peak RSS (+%.1f MB)" % (
+                            name, mb + "MB", kmer, stage, secs, nbases / max(secs, 1e-9), peak / 1e6, growth / 1e6))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+              'cpus': psutil.cpu_count(logical=False), 'seed': args.seed, 'min_count': args.c, 'results': results}
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=1)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = check_regressions(results, json.load(f), args.max_slowdown, args.max_rss_growth, args.min_secs)
+        for r in regressions: print("REGRESSION " + r)
+    failed = [r for r in results if r['error']]
+    if failed: print("Failed stages: %d" % len(failed))
+    if regressions or failed: raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+"""bench_startup.py: Time mercat's CLI startup and check it stays within a budget."""
+
+import os
+import sys
+import timeit
+import subprocess
+from argparse import ArgumentParser
+
+#modules that only the plotting, diversity and table stages may import
+heavy_modules = ['pandas', 'plotly', 'skbio', 'scipy', 'pyarrow', 'dask']
+
+#command: (arguments, expected exit status); argparse exits with 2 on bad arguments
+commands = {
+    'import': ([sys.executable, '-c', 'import mercat.mercat'], 0),
+    'help': ([sys.executable, '-m', 'mercat.mercat', '--help'], 0),
+    'bad-args': ([sys.executable, '-m', 'mercat.mercat', '-k', '3'], 2),
+}
+
+#the commands import mercat from this checkout of the repository, it need not be installed
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def command_env():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = repo_root + (os.pathsep + env['PYTHONPATH'] if env.get('PYTHONPATH') else "")
+    return env
+
+
+def time_command(cmd, repeat, status=0):
+    '''Best wall time of repeat runs of cmd, each of which has to exit with status'''
+    times = []
+    for _ in range(repeat):
+        start_time = timeit.default_timer()
+        returncode = subprocess.call(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=command_env())
+        times.append(timeit.default_timer() - start_time)
+        if returncode != status:
+            raise SystemExit("%s exited with status %d, expected %d" % (" ".join(cmd), returncode, status))
+    return min(times)
+
+
+def loaded_heavy_modules():
+    '''Heavy modules that importing mercat.mercat pulls in'''
+    code = ("import sys, mercat.mercat; print(' '.join(m for m in %r if m in sys.modules))" % heavy_modules)
+    return subprocess.check_output([sys.executable, '-c', code], env=command_env()).decode().split()
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark mercat startup time')
+    parser.add_argument('-r', type=int, default=5, help='runs per command, the best one counts [default = 5]')
+    parser.add_argument('--budget', type=float, default=1.0, help='maximum seconds for each command [default = 1.0]')
+    args = parser.parse_args()
+
+    baseline = time_command([sys.executable, '-c', 'pass'], args.r)
+    print("python interpreter: %.3f secs" % baseline)
+
+    over_budget = False
+    for name, (cmd, status) in sorted(commands.items()):
+        secs = time_command(cmd, args.r, status)
+        print("%-9s %.3f secs%s" % (name + ":", secs, "  OVER BUDGET" if secs > args.budget else ""))
+        over_budget = over_budget or secs > args.budget
+
+    heavy = loaded_heavy_modules()
+    if heavy: print("heavy modules imported at startup: " + ", ".join(heavy))
+    if over_budget or heavy: raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
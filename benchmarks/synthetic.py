@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+"""synthetic.py: Deterministic synthetic FASTQ reads, FASTA contigs and protein ORFs for the benchmarks."""
+
+import os
+import numpy as np
+from argparse import ArgumentParser
+
+nucleotides = np.frombuffer(b'ACGT', dtype=np.uint8)
+amino_acids = np.frombuffer(b'ACDEFGHIKLMNPQRSTVWY', dtype=np.uint8)
+
+#the same seed and size always give the same file
+default_seed = 2016
+read_length = 150
+contig_length = 50000
+orf_length = 300
+line_width = 60
+
+
+def random_letters(rng, alphabet, n):
+    return alphabet[rng.integers(0, len(alphabet), n)].tobytes()
+
+
+def wrap(seq, width=line_width):
+    return b'\n'.join(seq[i:i + width] for i in range(0, len(seq), width))
+
+
+def reference(rng, alphabet, nletters):
+    '''Random genome (or proteome) the sequences are sampled from, a tenth of their size so k-mers repeat like in a real sample'''
+    return np.frombuffer(random_letters(rng, alphabet, nletters // 10), dtype=np.uint8)
+
+
+def fragments(rng, ref, alphabet, length, n, error_rate):
+    '''n random fragments of ref with substitution errors'''
+    for start in rng.integers(0, len(ref) - length + 1, n).tolist():
+        seq = ref[start:start + length].copy()
+        errors = rng.random(length) < error_rate
+        seq[errors] = alphabet[rng.integers(0, len(alphabet), errors.sum())]
+        yield seq.tobytes()
+
+
+def write_reads(path, nbytes, seed=default_seed, error_rate=0.01):
+    '''FASTQ reads of read_length with 1% substitution errors, about nbytes in total'''
+    rng = np.random.default_rng(seed)
+    nreads = max(1, nbytes // (2 * read_length + 20))
+    ref = reference(rng, nucleotides, max(nreads, 10) * read_length)
+    quality = b'I' * read_length
+    with open(path, 'wb') as f:
+        for i, seq in enumerate(fragments(rng, ref, nucleotides, read_length, nreads, error_rate)):
+            f.write(b'@read%d\n%s\n+\n%s\n' % (i, seq, quality))
+    return path
+
+
+def write_contigs(path, nbytes, seed=default_seed, error_rate=0.001):
+    '''FASTA contigs of contig_length, about nbytes in total'''
+    rng = np.random.default_rng(seed)
+    ncontigs = max(1, nbytes // contig_length)
+    ref = reference(rng, nucleotides, max(ncontigs, 10) * contig_length)
+    with open(path, 'wb') as f:
+        for i, seq in enumerate(fragments(rng, ref, nucleotides, contig_length, ncontigs, error_rate)):
+            f.write(b'>contig%d\n%s\n' % (i, wrap(seq)))
+    return path
+
+
+def write_orfs(path, nbytes, seed=default_seed, error_rate=0.05):
+    '''Protein FASTA of ORFs (M, residues, *) like prodigal writes them, orf_length long and about nbytes in total'''
+    rng = np.random.default_rng(seed)
+    norfs = max(1, nbytes // orf_length)
+    ref = reference(rng, amino_acids, max(norfs, 10) * orf_length)
+    with open(path, 'wb') as f:
+        for i, seq in enumerate(fragments(rng, ref, amino_acids, orf_length - 2, norfs, error_rate)):
+            f.write(b'>orf%d\n%s\n' % (i, wrap(b'M' + seq + b'*')))
+    return path
+
+
+#dataset name: (generator, file extension, is protein)
+datasets = {
+    'reads': (write_reads, '.fq', False),
+    'contigs': (write_contigs, '.fna', False),
+    'orfs': (write_orfs, '.faa', True),
+}
+
+
+def dataset_file(directory, name, nbytes, seed=default_seed):
+    '''Path of a generated dataset, written only if it is not there yet'''
+    writer, ext, _ = datasets[name]
+    path = os.path.join(directory, "%s_%d_%d%s" % (name, nbytes, seed, ext))
+    if not os.path.exists(path):
+        writer(path + ".tmp", nbytes, seed)
+        os.rename(path + ".tmp", path)
+    return path
+
+
+def main():
+    parser = ArgumentParser(description='Write deterministic synthetic mercat inputs')
+    parser.add_argument('-d', type=str, default='.', help='output folder [default = .]')
+    parser.add_argument('--sizes', type=str, default='1', help='comma separated sizes in MB [default = 1]')
+    parser.add_argument('--datasets', type=str, default=','.join(sorted(datasets)), help='comma separated datasets [default = all]')
+    parser.add_argument('--seed', type=int, default=default_seed, help='random seed [default = %d]' % default_seed)
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.d): os.makedirs(args.d)
+    for name in args.datasets.split(','):
+        for mb in args.sizes.split(','):
+            print(dataset_file(args.d, name, int(float(mb) * 1024 * 1024), args.seed))
+
+
+if __name__ == "__main__":
+    main()
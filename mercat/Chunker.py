@@ -1,4 +1,6 @@
 import os
+import mmap
+import zlib
 import argparse
 import glob
 
@@ -136,6 +138,145 @@ def mercat_chunker(infile,outfolder,chunksize,delim,lines=None):
     Chunker(infile, outfolder, chunksize=chunksize, delim=delim, lines=lines)
 
 
+def is_fastq_record(mm, pos):
+    """
+    True if the line at pos looks like the header of a 4-line FASTQ record:
+    @name, sequence, +, and a quality line as long as the sequence.
+    Quality lines may also start with '@' but are never followed two lines
+    later by a '+' line.
+    """
+    if mm[pos:pos + 1] != b'@': return False
+    lines = []
+    for i in range(4):
+        eol = mm.find(b'\n', pos)
+        if eol < 0:
+            if i < 3: return False
+            eol = len(mm)
+        lines.append(mm[pos:eol].rstrip(b'\r'))
+        pos = eol + 1
+    return lines[2].startswith(b'+') and len(lines[1]) == len(lines[3])
+
+
+def next_record_offset(mm, pos, is_fastq):
+    """Byte offset of the first record header at or after pos, or len(mm) if there is none."""
+    if pos <= 0: return 0
+    marker = b'\n@' if is_fastq else b'\n>'
+    while True:
+        idx = mm.find(marker, pos - 1)
+        if idx < 0: return len(mm)
+        if not is_fastq or is_fastq_record(mm, idx + 1): return idx + 1
+        pos = idx + 2
+
+
+def find_record_start(buf, is_fastq):
+    """Offset of the first record header in buf that starts after its first newline, or None."""
+    marker = b'\n@' if is_fastq else b'\n>'
+    pos = buf.find(marker)
+    while pos >= 0:
+        if not is_fastq or is_fastq_record(buf, pos + 1): return pos + 1
+        pos = buf.find(marker, pos + 1)
+    return None
+
+
+gzip_magic = b'\x1f\x8b\x08'
+text_bytes = bytes(bytearray(range(32, 127))) + b'\n\r\t'
+
+def gzip_member_record_start(mm, offset, is_fastq, limit=1 << 22):
+    """
+    If a gzip member starts at offset, the offset of the first record header
+    within its decompressed data (looking at most limit bytes ahead), else
+    None. Candidates whose data does not decompress to plain text are
+    rejected, so gzip magic bytes inside compressed data are not mistaken for
+    a member start.
+    """
+    d = zlib.decompressobj(31)
+    out = b''
+    pos = offset
+    try:
+        while len(out) < limit and not d.eof and pos < len(mm):
+            data = d.decompress(mm[pos:pos + 65536])
+            pos += 65536
+            if data.translate(None, text_bytes): return None
+            out += data
+            start = find_record_start(out, is_fastq)
+            if start is not None: return start
+    except zlib.error:
+        return None
+    return None
+
+
+def mercat_gzip_partitioner(infile, chunksize, is_fastq, start=None, end=None):
+    """
+    Split a multi-member gzip or BGZF file (or its range [start, end)) into
+    ranges of about chunksize compressed bytes that begin on record
+    boundaries, so that each worker decompresses its own members. Offsets
+    are virtual: (member offset, offset inside the decompressed member).
+    A single-member gzip file cannot be split and yields one range.
+    """
+    if not isinstance(chunksize, int): chunksize = human2bytes(chunksize)
+    chunksize = max(chunksize, 1)
+    size = os.path.getsize(infile)
+    if start is None: start = (0, 0)
+    if end is None: end = (size, 0)
+    if end[0] <= start[0] or not size: return [(start, end)]
+
+    offsets = [start]
+    with open(infile, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            pos = start[0] + chunksize
+            while pos < end[0]:
+                member = mm.find(gzip_magic, pos)
+                if member < 0 or member >= end[0]: break
+                skip = gzip_member_record_start(mm, member, is_fastq)
+                if skip is None:
+                    pos = member + 1
+                    continue
+                offsets.append((member, skip))
+                pos = member + chunksize
+        finally:
+            mm.close()
+    offsets.append(end)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def mercat_partitioner(infile, chunksize, is_fastq, start=0, end=None):
+    """
+    Split infile (or its byte range [start, end)) into (start, end) ranges
+    of about chunksize bytes, each beginning on a FASTA/FASTQ record
+    boundary, so that workers can parse their range without copying the
+    file. chunksize is a byte count or a string understood by human2bytes.
+    gzip/BGZF files are split with mercat_gzip_partitioner, other
+    compressed files can only be streamed and yield a single range.
+    """
+    ext = os.path.splitext(infile)[1].lower()
+    if ext in ('.gz', '.bgz'):
+        if start == 0: start = None
+        return mercat_gzip_partitioner(infile, chunksize, is_fastq, start, end)
+    if ext in ('.bz2', '.xz'):
+        return [(start, end)]
+
+    if not isinstance(chunksize, int): chunksize = human2bytes(chunksize)
+    chunksize = max(chunksize, 1)
+    if end is None: end = os.path.getsize(infile)
+    if end <= start: return [(start, end)]
+
+    offsets = [start]
+    with open(infile, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            pos = start + chunksize
+            while pos < end:
+                offset = next_record_offset(mm, pos, is_fastq)
+                if offset >= end: break
+                offsets.append(offset)
+                pos = offset + chunksize
+        finally:
+            mm.close()
+    offsets.append(end)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Split input file into pieces.')
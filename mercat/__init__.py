@@ -2,9 +2,17 @@
 
 __version__ = "0.1"
 
-__import__('pkg_resources').declare_namespace("mercat")
+__path__ = __import__('pkgutil').extend_path(__path__, __name__)
 
 import mercat
 
 
+def __getattr__(name):
+    #the library API is imported on first use, "import mercat" stays cheap
+    if name == 'count_kmers':
+        from .mercat import count_kmers
+        return count_kmers
+    raise AttributeError("module 'mercat' has no attribute " + repr(name))
+
+
 
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+"""checkpoint.py: Content-hashed checkpoints of the chunks of a sample, for resuming interrupted runs."""
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from .seqreader import read_chunks
+from .spill import table_arrays
+
+
+def range_digest(path, start, end):
+    '''Hash of the (decompressed) bytes of a range of a file'''
+    h = hashlib.blake2b(digest_size=20)
+    for buf in read_chunks(path, start, end):
+        h.update(buf)
+    return h.hexdigest()
+
+
+def range_digests(path, ranges, num_workers):
+    '''range_digest of every (start, end) range, num_workers at a time (hashing and zlib release the GIL)'''
+    with ThreadPoolExecutor(max_workers=max(num_workers, 1)) as pool:
+        return list(pool.map(lambda r: range_digest(path, r[0], r[1]), ranges))
+
+
+def checkpoint_key(*parts):
+    '''Short hash of a content digest and everything else the checkpointed result depends on'''
+    return hashlib.blake2b(repr(parts).encode('utf-8'), digest_size=12).hexdigest()
+
+
+class ChunkCheckpoints(object):
+    '''
+    Checkpoints of the chunks of one sample, in one folder under mercat_results.
+    A chunk is done once its marker file (chunk-<key>.done, holding the number of
+    sequences and bases) exists; anything else with its key is the leftover of an
+    interrupted chunk. In memory mode the chunk's count tables are saved as
+    chunk-<key>/<k>.keys.npy and .counts.npy; in disk mode the chunk spills
+    into chunk-<key> subfolders of the KmerSpill folders, which live here too.
+    Without resume the folder starts out empty.
+    '''
+
+    def __init__(self, directory, resume=False):
+        self.directory = directory
+        if not resume and os.path.exists(directory): shutil.rmtree(directory)
+        if not os.path.exists(directory): os.makedirs(directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def marker(self, key):
+        return self.path("chunk-" + key + ".done")
+
+    def done(self, key):
+        return os.path.exists(self.marker(key))
+
+    def counted(self, key):
+        '''(sequences, bases) counted in a done chunk'''
+        with open(self.marker(key)) as f:
+            marker = json.load(f)
+        return marker['nseqs'], marker.get('nbases', 0)
+
+    def mark_done(self, key, nseqs=0, nbases=0):
+        #written to a temporary name first, so a marker is never half written
+        tmp = self.marker(key) + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump({'nseqs': nseqs, 'nbases': nbases}, f)
+        os.rename(tmp, self.marker(key))
+
+    def save_tables(self, key, tables, kmers, backends, nseqs, nbases=0):
+        '''Save the count tables of a chunk (one per k) and mark the chunk done'''
+        chunk_dir = self.path("chunk-" + key)
+        if os.path.exists(chunk_dir): shutil.rmtree(chunk_dir)
+        os.makedirs(chunk_dir)
+        for table, kmer, backend in zip(tables, kmers, backends):
+            keys, counts = table_arrays(table, backend, kmer)
+            np.save(os.path.join(chunk_dir, str(kmer) + ".keys.npy"), keys)
+            np.save(os.path.join(chunk_dir, str(kmer) + ".counts.npy"), counts)
+        self.mark_done(key, nseqs, nbases)
+
+    def load_tables(self, key, kmers, backends):
+        '''Count tables (one per k) of a done chunk, in the form the counting backends produce'''
+        tables = []
+        chunk_dir = self.path("chunk-" + key)
+        for kmer, backend in zip(kmers, backends):
+            keys = np.load(os.path.join(chunk_dir, str(kmer) + ".keys.npy"))
+            counts = np.load(os.path.join(chunk_dir, str(kmer) + ".counts.npy"))
+            if backend == 'numpy': tables.append((keys, counts))
+            else: tables.append(Counter(dict(zip(keys.astype(str).tolist(), counts.tolist()))))
+        return tuple(tables)
+
+    def prune(self, keys, keep=()):
+        '''Remove the checkpoints (chunk-<key>, sketch-<key>) whose key is not in keys, i.e. stale
+        or made with other options, and the leftovers of interrupted chunks. The folders named
+        in keep (the spill folders) are pruned inside, other files are left alone.'''
+        keys = set(keys)
+        for folder in [self.directory] + [self.path(name) for name in keep if os.path.isdir(self.path(name))]:
+            for name in os.listdir(folder):
+                fn = os.path.join(folder, name)
+                if name.startswith("chunk-") or name.startswith("sketch-"):
+                    key = name.split("-", 1)[1].split(".")[0]
+                    stale = (key not in keys or name.endswith(".tmp") or
+                             (os.path.isdir(fn) and not self.done(key)))
+                elif name.startswith("part-"):
+                    stale = True #spilled by a chunk that was not checkpointed
+                else:
+                    continue
+                if not stale: continue
+                if os.path.isdir(fn): shutil.rmtree(fn)
+                else: os.remove(fn)
+
+    def remove(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        try:
+            os.rmdir(os.path.dirname(self.directory)) #the checkpoints folder, once no sample has any left
+        except OSError:
+            pass
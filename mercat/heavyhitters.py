@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+"""heavyhitters.py: Bounded-memory Space-Saving summaries of the most frequent k-mers, merged across workers."""
+
+import numpy as np
+
+
+#k-mers a summary keeps per requested top k-mer, and at least
+capacity_per_top = 1000
+min_capacity = 1 << 16
+
+
+def summary_capacity(topn, capacity=None):
+    return int(capacity or max(min_capacity, capacity_per_top * topn))
+
+
+class KmerSummary(object):
+    '''
+    Space-Saving summary of a k-mer stream: at most capacity (key, count)
+    pairs, sorted by key, whose counts are upper bounds of the true counts,
+    and a floor that bounds the count of every k-mer not in the summary.
+    Summaries of separate parts of the input merge into a summary of the
+    whole (a k-mer missing from one part's summary is counted at that
+    part's floor), so workers summarize their batches on their own. Any
+    k-mer whose count exceeds the floor is in the summary, a count is at
+    most floor above the true one, and the floor stays below
+    (total count) / capacity.
+    '''
+
+    def __init__(self, keys, counts, floor=0, total=0):
+        self.keys = keys
+        self.counts = counts
+        self.floor = floor
+        self.total = total
+
+    @classmethod
+    def from_table(cls, keys, counts, capacity):
+        '''Summary of an exact (keys, counts) table'''
+        order = np.argsort(keys, kind='stable')
+        counts = np.asarray(counts, dtype=np.int64)[order]
+        return cls(keys[order], counts, 0, int(counts.sum())).truncate(capacity)
+
+    def truncate(self, capacity):
+        '''Keep the capacity largest counts (in key order); the largest one dropped becomes the floor'''
+        if len(self.counts) > capacity:
+            cut = len(self.counts) - capacity
+            order = np.argpartition(self.counts, cut - 1)
+            self.floor = max(self.floor, int(self.counts[order[cut - 1]]))
+            keep = np.sort(order[cut:])
+            self.keys, self.counts = self.keys[keep], self.counts[keep]
+        return self
+
+    @classmethod
+    def merge(cls, summaries, capacity):
+        summaries = [s for s in summaries if s is not None]
+        if len(summaries) == 1: return summaries[0]
+        keys, inverse = np.unique(np.concatenate([s.keys for s in summaries]), return_inverse=True)
+        #every k-mer starts at the sum of the floors and gets its own count over the floor where it is known
+        counts = np.full(len(keys), sum(s.floor for s in summaries), dtype=np.int64)
+        offset = 0
+        for s in summaries:
+            counts[inverse[offset:offset + len(s.keys)]] += s.counts - s.floor
+            offset += len(s.keys)
+        merged = cls(keys, counts, sum(s.floor for s in summaries), sum(s.total for s in summaries))
+        return merged.truncate(capacity)
+
+    def candidates(self, topn):
+        '''
+        Keys that can be among the topn. A count overestimates by at most the
+        floor, so a key whose count is below the topn-th largest (count - floor)
+        cannot be; k-mers outside the summary cannot be once that exceeds the floor.
+        '''
+        if len(self.counts) <= topn: return self.keys
+        lower = np.partition(self.counts, len(self.counts) - topn)[len(self.counts) - topn] - self.floor
+        return self.keys[self.counts >= lower]
+
+
+def candidate_counts(keys, counts, candidates):
+    '''Exact counts of the (sorted) candidate keys in an exact (keys, counts) table'''
+    result = np.zeros(len(candidates), dtype=np.int64)
+    if not len(keys) or not len(candidates): return result
+    pos = np.minimum(np.searchsorted(candidates, keys), len(candidates) - 1)
+    hit = candidates[pos] == keys
+    result[pos[hit]] = counts[hit] #keys of a table are unique
+    return result
+
+
+def is_exact(top, topn, floor):
+    '''True when the verified top counts are certainly the topn largest: no k-mer outside the summary (count <= floor) can beat them'''
+    if floor == 0: return True
+    return len(top) == topn and top[-1] >= floor
+
+
+def top_counts(candidates, counts, topn):
+    '''(keys, counts) of the topn largest counts, largest first, ties by key'''
+    order = np.lexsort((candidates, -counts))[:topn]
+    return candidates[order], counts[order]
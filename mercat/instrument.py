@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+"""instrument.py: Wall time, CPU time, peak memory and item counts of the stages of a run, for the JSON run report."""
+
+import os
+import sys
+import json
+import time
+import timeit
+import psutil
+import importlib.util
+import threading
+from contextlib import contextmanager
+
+
+#how often the memory of the open stages is sampled, in seconds
+rss_interval = 0.05
+
+
+def load_hook(spec):
+    '''The function named by "module:function" (or "path/to/file.py:function"), called with every finished stage record'''
+    if ':' not in spec: raise ValueError("expected module:function, got " + spec)
+    module_name, func_name = spec.rsplit(':', 1)
+    if module_name.endswith('.py'):
+        module_spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(module_name))[0], module_name)
+        module = importlib.util.module_from_spec(module_spec)
+        module_spec.loader.exec_module(module)
+    else:
+        module = importlib.import_module(module_name)
+    hook = getattr(module, func_name)
+    if not callable(hook): raise ValueError(spec + " is not callable")
+    return hook
+
+
+def process_tree(process):
+    '''This process and its (joblib, tool) worker processes'''
+    try:
+        return [process] + process.children(recursive=True)
+    except psutil.Error:
+        return [process]
+
+
+def tree_cpu_times(process):
+    '''{pid: user + system CPU seconds} of the process tree, plus the CPU time of its exited children under pid 0'''
+    times = dict()
+    for p in process_tree(process):
+        try:
+            t = p.cpu_times()
+        except psutil.Error:
+            continue
+        times[p.pid] = t.user + t.system
+    t = process.cpu_times()
+    times[0] = t.children_user + t.children_system
+    return times
+
+
+def tree_rss(process):
+    rss = 0
+    for p in process_tree(process):
+        try:
+            rss += p.memory_info().rss
+        except psutil.Error:
+            pass
+    return rss
+
+
+class RunReport(object):
+    '''
+    Records of the stages of a run, one per stage of a sample, chunk or k:
+    wall and CPU time (of this process and its workers), the peak RSS of the
+    process tree while the stage ran, and whatever counts the stage adds
+    (records, bytes, kmers, ...). Every finished record is passed to hook,
+    if given. Stages can nest; one sampling thread watches the memory of
+    all open stages.
+    '''
+
+    def __init__(self, hook=None):
+        self.hook = hook
+        self.records = []
+        self.process = psutil.Process()
+        self.open_stages = []
+        self.lock = threading.Lock()
+        self.sampler = None
+
+    def sample_rss(self):
+        while True:
+            time.sleep(rss_interval)
+            with self.lock:
+                if not self.open_stages:
+                    self.sampler = None
+                    return
+                stages = list(self.open_stages)
+            rss = tree_rss(self.process)
+            for record in stages:
+                record['peak_rss'] = max(record['peak_rss'], rss)
+
+    @contextmanager
+    def stage(self, name, **fields):
+        '''with report.stage("count", sample=..., chunk=i) as record: ... record["records"] = n'''
+        record = dict(stage=name, pid=os.getpid(), start=time.time())
+        record.update(fields)
+        record['peak_rss'] = tree_rss(self.process)
+        cpu_start = tree_cpu_times(self.process)
+        start_time = timeit.default_timer()
+        with self.lock:
+            self.open_stages.append(record)
+            if self.sampler is None:
+                self.sampler = threading.Thread(target=self.sample_rss)
+                self.sampler.daemon = True
+                self.sampler.start()
+        try:
+            yield record
+        except BaseException as e:
+            record['error'] = type(e).__name__ + ": " + (str(e).strip().splitlines() or [""])[0]
+            raise
+        finally:
+            record['wall'] = round(timeit.default_timer() - start_time, 4)
+            cpu_end = tree_cpu_times(self.process)
+            #a worker that exited during the stage moves its whole CPU time into the children times (pid 0)
+            cpu = sum(t - cpu_start.get(pid, 0.0) for pid, t in cpu_end.items())
+            cpu -= sum(t for pid, t in cpu_start.items() if pid not in cpu_end)
+            record['cpu'] = round(max(cpu, 0.0), 4)
+            record['peak_rss'] = max(record['peak_rss'], tree_rss(self.process))
+            with self.lock:
+                self.open_stages.remove(record)
+            self.records.append(record)
+            if self.hook is not None: self.hook(record)
+
+    def extend(self, records):
+        '''Add the records of a sample that ran in another process'''
+        self.records.extend(records)
+
+    def summary(self):
+        '''Wall time, CPU time and peak RSS per stage name, over all samples, chunks and k'''
+        totals = dict()
+        for record in self.records:
+            total = totals.setdefault(record['stage'], {'count': 0, 'wall': 0.0, 'cpu': 0.0, 'peak_rss': 0})
+            total['count'] += 1
+            total['wall'] = round(total['wall'] + record['wall'], 4)
+            total['cpu'] = round(total['cpu'] + record['cpu'], 4)
+            total['peak_rss'] = max(total['peak_rss'], record['peak_rss'])
+        return totals
+
+    def write(self, fn, **run):
+        '''Write the report as JSON: the run information given, a summary per stage and every record'''
+        report = dict(run)
+        report['argv'] = sys.argv
+        report['stages'] = self.summary()
+        report['records'] = self.records
+        with open(fn, 'w') as f:
+            json.dump(report, f, indent=1)
+        return fn
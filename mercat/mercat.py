@@ -8,27 +8,43 @@ __copyright__   = "Copyright 2016"
 import sys
 import re
 import os
-import glob
 import psutil
 import shutil
 import timeit
 import humanize
 import subprocess
-import pandas as pd
-from collections import OrderedDict
-from joblib import Parallel, delayed
-
-from argparse import ArgumentParser
+import numpy as np
+import itertools
+import multiprocessing
+from collections import Counter
+from joblib import Parallel, delayed, effective_n_jobs
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from argparse import ArgumentParser, ArgumentTypeError
 from argparse import RawDescriptionHelpFormatter
 
-import dask.dataframe as dd
-
 from .metrics import *
-from .Chunker import mercat_chunker
-
-
-def name(i):
-    return str(i)
+from .Chunker import mercat_partitioner
+from .packed import max_packed_kmer, calculateKmerCount_packed, merge_kmer_codes, decode_kmer_bytes
+from .packed import encode_sequences, kmer_codes, count_kmer_codes
+from .tables import table_formats, table_compressions, table_metadata, write_count_table, CountTableWriter
+from .spill import KmerSpill, estimate_table_bytes, spill_buckets, table_arrays
+from .sketch import CountMinSketch, sketch_width, sketch_depth
+from .samplematrix import save_kmer_vector, build_sample_matrix, save_sample_matrix, beta_diversity, write_distance_matrix
+from .seqreader import compression_of, strip_compression_ext, is_fastq_file, read_records
+from .checkpoint import ChunkCheckpoints, range_digests, checkpoint_key
+from .tools import tool_chunk_bytes, tool_pipeline, tool_output_file, tool_stage_sequences
+from .store import KmerStore, store_name
+from .instrument import RunReport, load_hook
+from .heavyhitters import KmerSummary, summary_capacity, candidate_counts, top_counts, is_exact
+
+
+def check_module(module):
+    try:
+        __import__(module)
+    except ImportError:
+        print("Mercat Error: python module %s not found, please setup %s using: conda install %s" %(module,module,module))
+        sys.exit(1)
 
 def check_command(cmd):
     cmd1 = cmd
@@ -45,6 +61,22 @@ def check_command(cmd):
 
 protein_file_ext = ['.fa','.fna','.ffn','.fasta']
 
+def kmer_list(value):
+    '''Parse -k: a single length, a comma separated list and/or ranges, e.g. 3,5 or 4-12'''
+    kmers = set()
+    try:
+        for part in value.split(","):
+            if "-" in part.strip()[1:]:
+                first, last = part.split("-", 1)
+                kmers.update(range(int(first), int(last) + 1))
+            elif part.strip():
+                kmers.add(int(part))
+    except ValueError:
+        raise ArgumentTypeError("invalid kmer length(s) " + value)
+    if not kmers or min(kmers) < 1:
+        raise ArgumentTypeError("kmer lengths should be positive integers, got " + value)
+    return sorted(kmers)
+
 def parseargs(argv=None):
 
     '''Command line options.'''
@@ -58,7 +90,7 @@ def parseargs(argv=None):
     parser = ArgumentParser(formatter_class=RawDescriptionHelpFormatter)
     parser.add_argument('-i', type=str, required=False, help='path-to-input-file') #default=nucleotide
     parser.add_argument('-f', type=str, required=False, help='path-to-folder-containing-input-files')
-    parser.add_argument('-k', type=int, required = True, help='kmer length')
+    parser.add_argument('-k', type=kmer_list, required = True, help='kmer length, or several lengths counted in one pass e.g. 3,5 or 4-12')
     parser.add_argument('-n', type=int, default=num_cores, help='no of cores [default = all]')  # no of cores to use
     parser.add_argument('-c', type=int, default=10, help='minimum kmer count [default = 10]')  # minimum kmer count to report
     parser.add_argument('-pro', action='store_true', help='protein input file')
@@ -67,6 +99,17 @@ def parseargs(argv=None):
     parser.add_argument('-p', action='store_true', help='run prodigal on fasta file')
     parser.add_argument('-t',type=int,nargs='?',const=30,required=False,help='Trimmomatic options')
     parser.add_argument('-s', type=int, nargs='?', const=100, required=False, help='Split into x MB files. Default = 100MB')
+    parser.add_argument('-fmt', type=str, default='csv', choices=table_formats, help='output format of the k-mer count tables [default = csv]')
+    parser.add_argument('-compress', type=str, required=False, help='compression of the k-mer count tables, depends on -fmt [default = snappy for parquet, none otherwise]')
+    parser.add_argument('-cache', type=str, required=False, help='folder to keep the protein property cache in across runs')
+    parser.add_argument('-b', type=str, default='auto', choices=['auto']+sorted(kmer_counters), help='kmer counting backend [default = auto]; regex reproduces the legacy (squared) counts')
+    parser.add_argument('-mode', type=str, default='auto', choices=['auto','memory','disk'], help='count in memory or spill partial counts to disk [default = auto, disk when the counts would not fit in -mem]')
+    parser.add_argument('-prefilter', action='store_true', help='read the input twice and keep only kmers a Count-Min sketch says can reach -c in the exact counts')
+    parser.add_argument('-mem', type=int, required=False, help='memory budget for counting in MB [default = half of the available memory]')
+    parser.add_argument('-resume', '--resume', action='store_true', help='checkpoint the chunks of split inputs, and reuse those an interrupted -resume run of the same inputs and options saved')
+    parser.add_argument('-store', type=str, required=False, help='folder of a k-mer store the samples are added to, its cohort summary is refreshed from the new samples only')
+    parser.add_argument('-top', type=int, required=False, help='only find the N most frequent kmers, in bounded memory, instead of counting them all')
+    parser.add_argument('-hook', type=str, required=False, help='module:function (or file.py:function) called with the record of every finished stage, for monitoring')
 
     # Process arguments
     args = parser.parse_args()
@@ -90,6 +133,34 @@ def parseargs(argv=None):
         if args.pro: parser.error("Can only provide one of -p or -pro option at a time")
         check_command('prodigal')
 
+    if args.compress and args.compress not in table_compressions[args.fmt]:
+        parser.error("-compress for -fmt " + args.fmt + " should be one of: " + str(table_compressions[args.fmt]))
+    if args.fmt == 'parquet': check_module('pyarrow')
+
+    if args.mem is not None and args.mem <= 0:
+        parser.error("-mem should be a positive number of MB")
+
+    if args.cache and not os.path.isdir(args.cache):
+        parser.error("cache folder " + args.cache + " does not exist.\n")
+
+    if args.store and os.path.exists(args.store) and not os.path.isdir(args.store):
+        parser.error("store " + args.store + " is not a folder.\n")
+
+    if args.top is not None:
+        if args.top < 1: parser.error("-top should be a positive number of kmers")
+        if args.store: parser.error("-top cannot add samples to a -store, the store needs all of their kmers")
+        if args.prefilter: parser.error("-top already reads the input twice, it cannot be combined with -prefilter")
+
+    if args.hook:
+        try:
+            load_hook(args.hook)
+        except Exception as e:
+            parser.error("cannot load -hook " + args.hook + ": " + str(e))
+
+    if args.b == 'numpy':
+        if args.pro or args.p: parser.error("-b numpy is only available for nucleotide input")
+        if max(args.k) > max_packed_kmer: parser.error("-b numpy supports kmer length up to " + str(max_packed_kmer))
+
     if args.t:
         if not args.q:
             parser.error("-t option has to be provided along with -q")
@@ -112,7 +183,12 @@ def get_all_substrings(input_string,kmer):
     length = len(input_string)
     return [input_string[i:i + kmer] for i in range(length-kmer+1)]
 
-def calculateKmerCount(cseq,kmer): ###(seq,cseq, prune_kmer,kmer):
+def calculateKmerCount(cseq,kmer):
+    '''Count every k-mer window of cseq in a single pass'''
+    return Counter(cseq[i:i + kmer] for i in range(len(cseq)-kmer+1))
+
+def calculateKmerCount_regex(cseq,kmer): ###(seq,cseq, prune_kmer,kmer):
+    '''Legacy counter: re-scans cseq for every window, so a k-mer seen n times is counted n*n times'''
     kmerlist = dict()
     ###kmerlist_all_seq = dict()
     #cseq = sequences[seq] #Get current sequence
@@ -130,8 +206,390 @@ def calculateKmerCount(cseq,kmer): ###(seq,cseq, prune_kmer,kmer):
     return kmerlist #[kmerlist,kmerlist_all_seq]
 
 
+#runs of unambiguous bases, the only places a nucleotide k-mer window can lie
+acgt_runs = re.compile(r'[ACGT]+')
+
+def calculateKmerCount_acgt(cseq,kmer):
+    '''Nucleotide dict counter: the windows the packed counter counts, upper case and ACGT only'''
+    return Counter(run[i:i + kmer] for run in acgt_runs.findall(cseq.upper()) for i in range(len(run)-kmer+1))
+
+def calculateKmerCount_regex_acgt(cseq,kmer):
+    '''Nucleotide legacy counter: upper case, k-mers with bases other than ACGT are dropped'''
+    kmerlist = calculateKmerCount_regex(cseq.upper(),kmer)
+    return dict((ss, n) for ss, n in kmerlist.items() if acgt_runs.fullmatch(ss))
+
+
+#k-mer counting backends selectable with -b
+kmer_counters = {
+    'dict': calculateKmerCount,
+    'numpy': calculateKmerCount_packed, #nucleotide only, k <= 32
+    'regex': calculateKmerCount_regex, #compatibility only
+}
+
+#the dict and regex backends of nucleotide input, so every backend and every k counts the same windows
+nucleotide_counters = {
+    'dict_acgt': calculateKmerCount_acgt,
+    'regex_acgt': calculateKmerCount_regex_acgt,
+}
+
+def select_backend(backend,kmer,is_protein):
+    '''Resolve the -b option, auto picks the 2-bit packed counter whenever it applies'''
+    if backend == 'auto':
+        if not is_protein and kmer <= max_packed_kmer: return 'numpy'
+        backend = 'dict'
+    if not is_protein and backend != 'numpy': return backend + '_acgt'
+    return backend
+
+
+#Bounds on the number of bases handed to one worker task
+min_batch_bases = 1 << 16
+max_batch_bases = 1 << 24
+
+def batch_size_bases(total_bases,num_cores):
+    '''Bases per worker task: a few tasks per core, within [min_batch_bases, max_batch_bases]'''
+    return int(min(max(total_bases // (4 * num_cores), min_batch_bases), max_batch_bases))
+
+def batch_sequences(seqs,batch_bases):
+    '''Group consecutive sequences into batches of about batch_bases bases'''
+    batch = []
+    nbases = 0
+    for cseq in seqs:
+        batch.append(cseq)
+        nbases += len(cseq)
+        if nbases >= batch_bases:
+            yield batch
+            batch = []
+            nbases = 0
+    if batch: yield batch
+
+def merge_counts(tables,backend):
+    '''Sum partial count tables: packed (codes, counts) tables for numpy, dicts otherwise.
+    With a tuple of backends (several k values) each table is a tuple with one table per k.'''
+    if isinstance(backend, tuple):
+        tables = list(tables)
+        return tuple(merge_counts([t[i] for t in tables], b) for i, b in enumerate(backend))
+    if backend == 'numpy': return merge_kmer_codes(tables)
+    kmerlist = Counter()
+    for d in tables: kmerlist.update(d)
+    return kmerlist
+
+def calculateKmerCountBatch(seqs,kmer,backend):
+    '''Count a batch of sequences into one partial table, or into one table per k for a tuple of k values'''
+    if isinstance(kmer, tuple):
+        #every k is counted from the same parsed batch, nucleotide batches are encoded only once
+        codes = encode_sequences(seqs) if 'numpy' in backend else None
+        return tuple(count_kmer_codes(kmer_codes(codes, k), k) if b == 'numpy' else calculateKmerCountBatch(seqs, k, b)
+                     for k, b in zip(kmer, backend))
+    if backend == 'numpy':
+        return count_kmer_codes(kmer_codes(encode_sequences(seqs), kmer), kmer)
+    if backend == 'dict':
+        return Counter(cseq[i:i + kmer] for cseq in seqs for i in range(len(cseq)-kmer+1))
+    if backend == 'dict_acgt':
+        return Counter(run[i:i + kmer] for cseq in seqs for run in acgt_runs.findall(cseq.upper())
+                       for i in range(len(run)-kmer+1))
+    counter = nucleotide_counters[backend] if backend in nucleotide_counters else kmer_counters[backend]
+    return merge_counts([counter(cseq, kmer) for cseq in seqs], backend)
+
+def tree_reduce_counts(tables,backend,num_cores,parallel=None):
+    '''Combine partial tables in parallel rounds until a single table is left'''
+    if parallel is None: parallel = Parallel(n_jobs=num_cores)
+    tables = list(tables)
+    while len(tables) > 1:
+        fanin = max(2, -(-len(tables) // num_cores))
+        groups = [tables[i:i + fanin] for i in range(0, len(tables), fanin)]
+        if len(groups) == 1:
+            tables = [merge_counts(groups[0], backend)]
+        else:
+            tables = parallel(delayed(merge_counts)(g, backend) for g in groups)
+    return merge_counts(tables, backend)
+
+def finish_table(kmertable,kmer,backend,spill=None,sketch=None):
+    '''
+    Last step of a worker task. While a prefilter sketch is being built the
+    task only returns the sketch cells it touched; once built, k-mers that
+    cannot reach -c are dropped. In disk mode the table is then written to
+    the spill files instead of being returned.
+    '''
+    if isinstance(kmer, tuple):
+        return tuple(finish_table(kmertable[i], k, backend[i], spill and spill[i], sketch and sketch[i])
+                     for i, k in enumerate(kmer))
+    if sketch is not None:
+        if sketch.building: return sketch.cells(kmertable, backend, kmer)
+        kmertable = sketch.admit(kmertable, backend, kmer)
+    if spill is None: return kmertable
+    spill.write(kmertable)
+    return merge_counts([], backend)
+
+def countBatchTask(seqs,kmer,backend,spill=None,sketch=None):
+    return finish_table(calculateKmerCountBatch(seqs, kmer, backend), kmer, backend, spill, sketch), len(seqs), sum(map(len, seqs))
+
+def countRangeTask(path,start,end,is_fastq,kmer,backend,spill=None,sketch=None):
+    '''Parse the records in the byte range [start, end) of path and count them into one partial table'''
+    seqs = [cseq for _, cseq in read_records(path, is_fastq, start, end)]
+    return countBatchTask(seqs, kmer, backend, spill, sketch)
+
+def topBatchTask(seqs,kmer,backend,capacity,candidates=None):
+    '''Count a batch exactly, then keep a Space-Saving summary of it per k,
+    or with candidates (a sorted array per k) only the candidates' counts'''
+    tables = calculateKmerCountBatch(seqs, kmer, backend)
+    results = []
+    for table, k, b, kcandidates in zip(tables, kmer, backend, candidates or [None] * len(kmer)):
+        keys, counts = table_arrays(table, b, k)
+        if kcandidates is None: results.append(KmerSummary.from_table(keys, counts, capacity))
+        else: results.append(candidate_counts(keys, counts, kcandidates))
+    return tuple(results), len(seqs), sum(map(len, seqs))
+
+def topRangeTask(path,start,end,is_fastq,kmer,backend,capacity,candidates=None):
+    seqs = [cseq for _, cseq in read_records(path, is_fastq, start, end)]
+    return topBatchTask(seqs, kmer, backend, capacity, candidates)
+
+def sketch_building(sketch):
+    '''True while a prefilter sketch (or one of a tuple of sketches) is still being filled'''
+    if isinstance(sketch, tuple): return any(sketch_building(s) for s in sketch)
+    return sketch is not None and sketch.building
+
+def fold_sketch(sketch,cell_tables,num_cores,parallel):
+    '''Add the sketch cells returned by a round of tasks to the sketch'''
+    if isinstance(sketch, tuple):
+        for i, s in enumerate(sketch): fold_sketch(s, [t[i] for t in cell_tables], num_cores, parallel)
+        return
+    #sketch cells are packed (cell id, count) tables whatever the counting backend
+    sketch.add(tree_reduce_counts(cell_tables, 'numpy', num_cores, parallel))
+
+#tasks run per core before their partial tables are folded into the running total
+batches_per_round = 4
+
+def reduce_in_rounds(tasks,backend,num_cores,sketch=None,parallel=None):
+    '''Run (table, nseqs, nbases) tasks a few per core at a time and fold each round into the running total.
+    Returns the merged table and the number of sequences and bases counted. While a sketch is being built
+    the rounds are folded into the sketch and the returned table is empty. A caller's joblib
+    Parallel is used as is, otherwise one is opened for the duration of the call.'''
+    if parallel is None:
+        with Parallel(n_jobs=num_cores) as parallel:
+            return reduce_in_rounds(tasks, backend, num_cores, sketch, parallel)
+
+    kmertable = merge_counts([], backend)
+    nseqs = nbases = 0
+    while True:
+        round_tasks = list(itertools.islice(tasks, batches_per_round * num_cores))
+        if not round_tasks: break
+        results = parallel(round_tasks)
+        del round_tasks
+        nseqs += sum(n for _, n, _ in results)
+        nbases += sum(b for _, _, b in results)
+        if sketch_building(sketch):
+            fold_sketch(sketch, [t for t, _, _ in results], num_cores, parallel)
+            continue
+        partial = tree_reduce_counts([t for t, _, _ in results], backend, num_cores, parallel)
+        del results
+        kmertable = merge_counts([kmertable, partial], backend)
+    return kmertable, nseqs, nbases
+
+def count_sequences(seqs,kmer,backend,num_cores,batch_bases,spill=None,sketch=None,parallel=None):
+    '''Count a stream of sequences, reading only a few batches per core ahead of the workers'''
+    batches = batch_sequences(seqs, batch_bases)
+    return reduce_in_rounds((delayed(countBatchTask)(batch, kmer, backend, spill, sketch) for batch in batches),
+                            backend, num_cores, sketch, parallel)
+
+def input_tasks(path,range_task,batch_task,args,num_cores,start=0,end=None,is_fastq=None):
+    '''Worker tasks over a FASTA/FASTQ file, or a record-aligned range of it.
+    Plain and multi-member gzip/BGZF files are split at record boundaries and every
+    worker parses (and decompresses) its own piece with range_task(path, start, end, is_fastq, *args),
+    other compressed files are streamed in batches of sequences for batch_task(seqs, *args).'''
+    if is_fastq is None: is_fastq = is_fastq_file(path)
+    compression = compression_of(path)
+    size = os.stat(path).st_size
+    if isinstance(start, tuple): span = (end or (size, 0))[0] - start[0]
+    else: span = (size if end is None else end) - start
+    batch_bytes = batch_size_bases(span, num_cores)
+
+    if compression in (None, 'gzip'):
+        ranges = mercat_partitioner(path, batch_bytes, is_fastq, start, end)
+        if compression is None or len(ranges) > 1:
+            for rstart, rend in ranges:
+                yield delayed(range_task)(path, rstart, rend, is_fastq, *args)
+            return
+
+    #single-member gzip, bz2 and xz files can only be decompressed as one stream
+    seqs = (cseq for _, cseq in read_records(path, is_fastq, start, end))
+    for batch in batch_sequences(seqs, batch_bytes):
+        yield delayed(batch_task)(batch, *args)
+
+def count_file(path,kmer,backend,num_cores,start=0,end=None,is_fastq=None,spill=None,sketch=None,parallel=None):
+    '''Count a FASTA/FASTQ file, or a record-aligned range of it (see input_tasks).
+    With a KmerSpill the partial tables go to disk and an empty table is returned.
+    With a CountMinSketch the file is either sketched or counted through the sketch filter.'''
+    tasks = input_tasks(path, countRangeTask, countBatchTask, (kmer, backend, spill, sketch), num_cores, start, end, is_fastq)
+    return reduce_in_rounds(tasks, backend, num_cores, sketch, parallel)
+
+def fold_top_rounds(tasks,num_cores,capacity,parallel):
+    '''Run topBatchTask/topRangeTask tasks a few per core at a time and fold each round into the running
+    result per k: summaries (first pass) are merged, candidate counts (second pass) summed'''
+    folded = None
+    nseqs = nbases = 0
+    while True:
+        round_tasks = list(itertools.islice(tasks, batches_per_round * num_cores))
+        if not round_tasks: break
+        results = parallel(round_tasks)
+        nseqs += sum(n for _, n, _ in results)
+        nbases += sum(b for _, _, b in results)
+        parts = [r for r, _, _ in results] + ([folded] if folded is not None else [])
+        folded = tuple(KmerSummary.merge([p[i] for p in parts], capacity) if isinstance(parts[0][i], KmerSummary)
+                       else sum(p[i] for p in parts) for i in range(len(parts[0])))
+    return folded, nseqs, nbases
+
+
+def count_chunk(path,chunk_range,kmer,backend,num_cores,spill=None,sketch=None,checkpoints=None,key=None):
+    '''count_file for one chunk of a sample, through its checkpoint: a chunk that is done is loaded,
+    any other is counted (its spilled parts into a subfolder of its own) and checkpointed'''
+    if checkpoints is None or key is None or sketch_building(sketch):
+        return count_file(path, kmer, backend, num_cores, chunk_range[0], chunk_range[1], spill=spill, sketch=sketch)
+    if checkpoints.done(key):
+        return (checkpoints.load_tables(key, kmer, backend),) + checkpoints.counted(key)
+    chunk_spill = None if spill is None else tuple(sp.chunk("chunk-" + key) for sp in spill)
+    kmertable, nseqs, nbases = count_file(path, kmer, backend, num_cores, chunk_range[0], chunk_range[1], spill=chunk_spill, sketch=sketch)
+    checkpoints.save_tables(key, kmertable, kmer, backend, nseqs, nbases)
+    return kmertable, nseqs, nbases
+
+
+def summary_frame(kmers,counts,kmer,is_protein,property_cache=None):
+    '''Summary table of k-mers given as strings, bytes or 2-bit packed codes'''
+    kmers = kmers if isinstance(kmers, list) else np.asarray(kmers)
+    if not isinstance(kmers, list) and kmers.dtype == np.uint64:
+        #only the k-mers that survive -c are decoded back to strings
+        kmers = decode_kmer_bytes(kmers, kmer)
+    if is_protein:
+        return protein_summary(kmers, counts, property_cache)
+    return nucleotide_summary(kmers, counts)
+
+def link_final_summary(summary_file, basename_k):
+    '''
+    Earlier releases wrote the merged CSV table to <sample>_finalSummary0.csv,
+    keep that name as a hard link (a copy where links are not supported) to
+    the CSV summary
+    '''
+    final_file = basename_k + "_finalSummary0" + summary_file[len(basename_k + "_summary"):]
+    if os.path.exists(final_file): os.remove(final_file)
+    try:
+        os.link(summary_file, final_file)
+    except OSError:
+        shutil.copyfile(summary_file, final_file)
+
+
+def summarize_counts(kmertable,backend,kmer,prune_kmer,is_protein,property_cache=None):
+    '''Summary table of the k-mers with count >= prune_kmer, and the number of distinct k-mers counted'''
+    if backend == 'numpy':
+        codes, counts = kmertable
+        num_kmers = len(codes)
+        significant = counts >= prune_kmer
+        significant_kmers = codes[significant]
+        significant_counts = counts[significant]
+    else:
+        num_kmers = len(kmertable)
+        significant_kmers = [k for k in kmertable if kmertable[k] >= prune_kmer]
+        significant_counts = [kmertable[k] for k in significant_kmers]
+
+    return summary_frame(significant_kmers, significant_counts, kmer, is_protein, property_cache), num_kmers
+
+def summarize_spilled_counts(spill,prune_kmer,is_protein,writer,num_cores,property_cache=None,topn=10):
+    '''
+    Count the buckets of a KmerSpill a few at a time and stream their summary rows
+    into a CountTableWriter. Returns the top topn rows, the total count, the keys
+    and counts of all k-mers with count >= prune_kmer and the number of distinct k-mers.
+    '''
+    import pandas as pd
+    top = None
+    total_count = 0
+    all_keys = []
+    all_counts = []
+    num_kmers = 0
+    #the part offsets are read once here rather than by every bucket task
+    spill.load_offsets()
+    with Parallel(n_jobs=num_cores) as parallel:
+        for first in range(0, spill.nbuckets, num_cores):
+            buckets = range(first, min(first + num_cores, spill.nbuckets))
+            for keys, counts, ndistinct in parallel(delayed(spill.count_bucket)(b, prune_kmer) for b in buckets):
+                num_kmers += ndistinct
+                if not len(keys): continue
+                df = summary_frame(keys, counts, spill.kmer, is_protein, property_cache)
+                writer.append(df)
+                total_count += int(counts.sum())
+                all_keys.append(keys)
+                all_counts.append(counts)
+                top = df.nlargest(topn, 'Count') if top is None else pd.concat([top, df]).nlargest(topn, 'Count')
+
+    empty = summary_frame([], [], spill.kmer, is_protein)
+    writer.close(empty)
+    if top is None: top = empty
+    all_keys = np.concatenate(all_keys) if all_keys else table_arrays(merge_counts([], spill.backend), spill.backend, spill.kmer)[0]
+    all_counts = np.concatenate(all_counts) if all_counts else np.zeros(0, dtype=np.int64)
+    return top, total_count, all_keys, all_counts, num_kmers
+
+
+def count_kmers(records_or_path,k,min_count=1,alphabet='nucleotide',n_jobs=1,parallel=None,backend='auto',
+                output='frame',properties=False):
+    '''
+    Count k-mers in-process, without writing files or changing the working directory.
+
+    records_or_path is a (plain or compressed) FASTA/FASTQ file, or an iterable of
+    sequences or (name, sequence) records. k is one length or a list of lengths,
+    alphabet is 'nucleotide' or 'protein', and k-mers seen fewer than min_count
+    times are dropped. output='frame' gives a DataFrame indexed by k-mer with a
+    Count column (plus GC_Percent/AT_Percent or PI/MW/Hydro if properties is True);
+    output='arrays' gives a (k-mer byte strings, counts) pair of arrays. For a list
+    of lengths the result is a dict from k to the result for that k.
+
+    parallel can be a joblib Parallel that the caller keeps open across calls
+    (e.g. "with Parallel(n_jobs=8) as parallel"), so its workers are reused;
+    otherwise n_jobs workers are used for this call. Bad arguments raise ValueError.
+    '''
+    if alphabet not in ('nucleotide', 'protein'):
+        raise ValueError("alphabet should be 'nucleotide' or 'protein', got " + repr(alphabet))
+    if output not in ('frame', 'arrays'):
+        raise ValueError("output should be 'frame' or 'arrays', got " + repr(output))
+    if backend != 'auto' and backend not in kmer_counters:
+        raise ValueError("backend should be one of " + str(['auto'] + sorted(kmer_counters)))
+
+    kmers = tuple(k) if isinstance(k, (list, tuple)) else (k,)
+    if not kmers or min(kmers) < 1:
+        raise ValueError("k should be a positive integer or a list of them, got " + repr(k))
+    is_protein = alphabet == 'protein'
+    if backend == 'numpy' and (is_protein or max(kmers) > max_packed_kmer):
+        raise ValueError("backend numpy counts nucleotide k-mers up to k = " + str(max_packed_kmer))
+    backends = tuple(select_backend(backend, kk, is_protein) for kk in kmers)
+
+    if parallel is not None: n_jobs = parallel.n_jobs
+    num_cores = effective_n_jobs(n_jobs)
+
+    if isinstance(records_or_path, (str, bytes, os.PathLike)):
+        tables, _, _ = count_file(os.fsdecode(records_or_path), kmers, backends, num_cores, parallel=parallel)
+    else:
+        total_bases = max_batch_bases
+        if isinstance(records_or_path, (list, tuple)):
+            total_bases = sum(len(r if isinstance(r, str) else r[1]) for r in records_or_path)
+        seqs = ((r if isinstance(r, str) else r[1]).replace("*","") for r in records_or_path)
+        tables, _, _ = count_sequences(seqs, kmers, backends, num_cores, batch_size_bases(total_bases, num_cores),
+                                    parallel=parallel)
+
+    import pandas as pd
+    results = dict()
+    for kk, kbackend, table in zip(kmers, backends, tables):
+        if properties and output == 'frame':
+            results[kk], _ = summarize_counts(table, kbackend, kk, min_count, is_protein)
+            continue
+        keys, counts = table_arrays(table, kbackend, kk)
+        significant = counts >= min_count
+        keys, counts = keys[significant], counts[significant]
+        if kbackend == 'numpy': keys = decode_kmer_bytes(keys, kk)
+        if output == 'arrays': results[kk] = (keys, counts)
+        else: results[kk] = pd.DataFrame({'Count': counts}, index=kmer_index(keys), columns=['Count'])
+
+    if isinstance(k, (list, tuple)): return results
+    return results[k]
+
+
 def check_args(ipfile,args,def_option,m_parser):
-    given_ext = (os.path.splitext(ipfile)[1]).strip()
+    given_ext = (os.path.splitext(strip_compression_ext(ipfile))[1]).strip()
     if def_option:
         if given_ext not in protein_file_ext:
             m_parser.error("Input file provided should be one of the following formats: " + str(protein_file_ext))
@@ -149,33 +607,609 @@ def check_args(ipfile,args,def_option,m_parser):
             m_parser.error("Input file provided should be in .faa format")
 
 
+def range_size(chunk_range,size):
+    '''Bytes of a (start, end) range of an input file of size bytes, gzip (member, skip) offsets included'''
+    start, end = chunk_range
+    start = start[0] if isinstance(start, tuple) else (start or 0)
+    end = size if end is None else (end[0] if isinstance(end, tuple) else end)
+    return end - start
+
+def tool_chunk_jobs(m_inputfile,__args__,num_cores,dir_runs,sample_name,np_string):
+    '''tool_stage_sequences jobs for the chunks of an input: the external tools are single-threaded,
+    so the input is split for every core to have a few chunks'''
+    mfile_size_split = __args__.s or 100
+    partitions = mercat_partitioner(m_inputfile, tool_chunk_bytes(os.stat(m_inputfile).st_size, num_cores, mfile_size_split*1024*1024),
+                                    is_fastq_file(m_inputfile))
+    jobs = []
+    for ichunk, chunk_range in enumerate(partitions):
+        bif = os.path.join(dir_runs, sample_name + "_" + np_string)
+        if len(partitions) > 1: bif = os.path.join(dir_runs, sample_name + ".%05d" % ichunk + "_" + np_string)
+        jobs.append((m_inputfile, chunk_range, bif, __args__.t, __args__.p, dir_runs))
+    return jobs
+
+def mercat_sample(m_inputfile,results_dir,__args__,num_cores,memory_budget,property_caches,save_caches=False):
+    '''
+    Count one input file and write its summaries and diversity files under
+    results_dir. Every path is explicit (no chdir), so several samples can
+    run at once in separate processes. Returns the sample name, the top 10
+    k-mers and total count per k, the property cache hits and misses per k,
+    for folder and -store runs the saved k-mer vector (save_kmer_vector prefix)
+    per k, and the stage records of the run report.
+    '''
+    report = RunReport(load_hook(__args__.hook) if __args__.hook else None)
+    sample_name = os.path.splitext(os.path.basename(strip_compression_ext(m_inputfile)))[0]
+    try:
+        with report.stage('sample', sample=sample_name, bytes=os.stat(m_inputfile).st_size, cores=num_cores):
+            if __args__.top: result = top_sample(m_inputfile, results_dir, __args__, num_cores, property_caches, report, save_caches)
+            else: result = count_sample(m_inputfile, results_dir, __args__, num_cores, memory_budget, property_caches, report, save_caches)
+    except subprocess.CalledProcessError as e:
+        print("Mercat Error: external tools failed on %s with exit status %d: %s\n%s" % (sample_name, e.returncode, e.cmd, e.stderr or ""))
+        sys.exit(1)
+    return result + (report.records,)
+
+def count_sample(m_inputfile,results_dir,__args__,num_cores,memory_budget,property_caches,report,save_caches=False):
+    '''mercat_sample, with every stage recorded in report'''
+    kmers = tuple(__args__.k)
+    prune_kmer = __args__.c
+    mflag_prodigal = __args__.p
+    mflag_trimmomatic = __args__.t
+    mfile_size_split = __args__.s or 100
+
+    np_string = "nucleotide"
+    if __args__.pro or mflag_prodigal: np_string = "protein"
+    mflag_protein = np_string == "protein"
+
+    #all k values are counted in one pass, with one set of outputs per k
+    kmerstrings = dict((k, str(k) + "-mers") for k in kmers)
+    kmerstring_all = ",".join(str(k) for k in kmers) + "-mers"
+    multi_k = len(kmers) > 1
+
+    count_backend = tuple(select_backend(__args__.b, k, mflag_protein) for k in kmers)
+    alphabet_size = 20 if mflag_protein else 4
+    cache_start = dict((k, (c.hits, c.misses)) for k, c in property_caches.items() if c is not None)
+
+
+    m_inputfile = os.path.abspath(m_inputfile)
+
+    sample_name = os.path.splitext(os.path.basename(strip_compression_ext(m_inputfile)))[0]
+    basename_ipfile = sample_name + "_" + np_string
+
+    inputfile_size = os.stat(m_inputfile).st_size
+    dir_runs = os.path.join(results_dir, basename_ipfile + "_run")
+
+    #-resume keeps the run folder, the tool output of checkpointed chunks is read back from it
+    if os.path.exists(dir_runs) and not __args__.resume:
+        shutil.rmtree(dir_runs)
+    if not os.path.exists(dir_runs): os.makedirs(dir_runs)
+
+    partitions = [(0, None)]
+    is_chunked = False
+    tool_jobs = []
+    with report.stage('partition', sample=sample_name, bytes=inputfile_size) as record:
+        if mflag_trimmomatic or mflag_prodigal:
+            tool_jobs = tool_chunk_jobs(m_inputfile, __args__, num_cores, dir_runs, sample_name, np_string)
+            partitions = [job[1] for job in tool_jobs]
+            is_chunked = len(partitions) > 1
+        elif inputfile_size >= (mfile_size_split*1024*1024): #100MB
+            print("Large input file provided: Splitting it into smaller byte ranges...\n")
+            partitions = mercat_partitioner(m_inputfile, str(mfile_size_split)+"M", is_fastq_file(m_inputfile))
+            is_chunked = True
+        record['chunks'] = len(partitions)
+
+    #with -resume chunked inputs are checkpointed a chunk at a time under mercat_results/checkpoints,
+    #other runs neither hash nor save their chunks and drop the checkpoints of earlier runs
+    checkpoints = None
+    checkpoint_dir = os.path.join(results_dir, "checkpoints", basename_ipfile)
+    if is_chunked and __args__.resume:
+        checkpoints = ChunkCheckpoints(checkpoint_dir, resume=True)
+    elif os.path.exists(checkpoint_dir):
+        shutil.rmtree(checkpoint_dir)
+
+    #compressed inputs hold roughly 4 bases per byte
+    input_bases = inputfile_size * (4 if compression_of(m_inputfile) else 1)
+    table_bytes = [estimate_table_bytes(input_bases, k, alphabet_size, b) for k, b in zip(kmers, count_backend)]
+    spill = None
+    if __args__.mode == 'disk' or (__args__.mode == 'auto' and sum(table_bytes) > memory_budget):
+        spill_dir = dir_runs if checkpoints is None else checkpoints.directory
+        #only checkpointed chunks can reuse spilled parts, anything else left in the run folder is from an interrupted run
+        if checkpoints is None:
+            for k in kmers: shutil.rmtree(os.path.join(spill_dir, "kmer_spill_" + str(k)), ignore_errors=True)
+        spill = tuple(KmerSpill(os.path.join(spill_dir, "kmer_spill_" + str(k)), spill_buckets(nbytes, memory_budget, num_cores), b, k)
+                      for k, b, nbytes in zip(kmers, count_backend, table_bytes))
+        print("Counting on disk: spilling partial " + kmerstring_all + " counts into " +
+              ", ".join(str(sp.nbuckets) for sp in spill) + " buckets")
+
+    #first pass fills the sketches, the exact counts are taken in a second pass over count_inputs
+    sketch = None
+    count_inputs = []
+    if __args__.prefilter and prune_kmer > 1:
+        sketch = tuple(CountMinSketch(sketch_width(input_bases, k, alphabet_size, memory_budget // len(kmers)),
+                                      sketch_depth, prune_kmer) for k in kmers)
+    sketch_files = [os.path.join(dir_runs, "kmer_sketch_" + str(k) + ".npy") for k in kmers]
+
+    #a checkpoint is keyed by the content of its input range and the options its result depends on:
+    #tool chunks keep their tool output, counted chunks their partial counts (after the prefilter)
+    chunk_keys = [None] * len(partitions)
+    count_keys = chunk_keys
+    if checkpoints is not None:
+        print("Hashing " + str(len(partitions)) + " input chunks for their checkpoints")
+        with report.stage('checkpoint_hash', sample=sample_name, bytes=inputfile_size, chunks=len(partitions)):
+            digests = range_digests(m_inputfile, partitions, num_cores)
+        if tool_jobs: options = (mflag_trimmomatic, mflag_prodigal)
+        else: options = (kmers, np_string, count_backend, spill and tuple(sp.nbuckets for sp in spill))
+        chunk_keys = [checkpoint_key(digest, options) for digest in digests]
+        count_keys = [] if tool_jobs else chunk_keys
+        sketch_key = None
+        if sketch is not None:
+            sketch_key = checkpoint_key(chunk_keys, tuple(sk.width for sk in sketch), sketch_depth, prune_kmer)
+            sketch_files = [checkpoints.path("sketch-" + sketch_key + "." + str(k) + ".npy") for k in kmers]
+            if not tool_jobs: count_keys = [checkpoint_key(key, sketch_key) for key in chunk_keys]
+        checkpoints.prune(chunk_keys + count_keys + [sketch_key], keep=["kmer_spill_" + str(k) for k in kmers])
+        if sketch is not None and all(os.path.exists(fn) for fn in sketch_files):
+            for sk, fn in zip(sketch, sketch_files): sk.load(fn)
+            print("Resuming with the prefilter sketch of the interrupted run")
+    sketch_built = sketch_building(sketch)
+
+    sample_table = None
+    top10 = dict()
+    #folder runs keep the significant k-mers of every sample for the sample x k-mer matrix, -store for the store
+    save_vectors = bool(__args__.f or __args__.store)
+    vectors = dict()
+
+    #trimmomatic and prodigal run on several chunks at once and their output is piped
+    #straight into the counter; the chunks left for the loop below are counted directly
+    if tool_jobs:
+        #chunks whose tool run completed before are counted from their saved tool output
+        tool_files = [tool_output_file(bif, trim_window, gene_calls) for _, _, bif, trim_window, gene_calls, _ in tool_jobs]
+        finished = [key is not None and checkpoints.done(key) and os.path.exists(fn) for key, fn in zip(chunk_keys, tool_files)]
+        pending_jobs = [job for job, done in zip(tool_jobs, finished) if not done]
+        job_keys = dict((job[2], key) for job, key in zip(tool_jobs, chunk_keys))
+        on_done = None if checkpoints is None else (lambda job: checkpoints.mark_done(job_keys[job[2]]))
+
+        print(tool_pipeline(tool_jobs[0][2], mflag_trimmomatic, mflag_prodigal))
+        if len(pending_jobs) < len(tool_jobs):
+            print("Resuming: " + str(len(tool_jobs) - len(pending_jobs)) + " chunks already have their tool output")
+        print("Running external tools on " + str(len(pending_jobs)) + " chunks, " +
+              str(min(num_cores, len(pending_jobs))) + " at a time")
+        print("Running mercat using " + str(num_cores) + " cores")
+
+        start_time = timeit.default_timer()
+
+        #the tools and the counting of their output run together, they are one stage
+        with report.stage('tools', sample=sample_name, chunks=len(tool_jobs), resumed=len(tool_jobs) - len(pending_jobs),
+                          sketch=sketch_built) as record:
+            seqs = tool_stage_sequences(pending_jobs, num_cores, on_done)
+            sample_table, num_sequences, num_bases = count_sequences(seqs, kmers, count_backend, num_cores,
+                                                                     batch_size_bases(input_bases, num_cores), spill=spill, sketch=sketch)
+            for fn, done in zip(tool_files, finished):
+                if not done: continue
+                kmertable, nseqs, nbases = count_file(fn, kmers, count_backend, num_cores, spill=spill, sketch=sketch)
+                sample_table = merge_counts([sample_table, kmertable], count_backend)
+                num_sequences += nseqs
+                num_bases += nbases
+                del kmertable
+            record.update(records=num_sequences, bases=num_bases)
+        for fn in tool_files:
+            count_inputs.append((fn, (0, None), None))
+
+        print("Number of sequences in the tool output = " + str(humanize.intword(num_sequences)))
+        if sketch is not None: print("Time to sketch " + kmerstring_all +  ": " + str(round(timeit.default_timer() - start_time,2)) + " secs")
+        else: print("Time to compute " + kmerstring_all +  ": " + str(round(timeit.default_timer() - start_time,2)) + " secs")
+        partitions = []
+
+    for ichunk, chunk_range in enumerate(partitions):
+
+        inputfile = m_inputfile
+
+        print("Running mercat using " + str(num_cores) + " cores")
+        print("input file: " + inputfile)
+        resumed = checkpoints is not None and not sketch_built and checkpoints.done(count_keys[ichunk])
+        if resumed:
+            print("Chunk " + str(ichunk) + " is loaded from its checkpoint")
+
+        start_time = timeit.default_timer()
+
+        with report.stage('sketch' if sketch_built else 'count', sample=sample_name, chunk=ichunk,
+                          bytes=range_size(chunk_range, inputfile_size), resumed=resumed) as record:
+            kmertable, num_sequences, num_bases = count_chunk(inputfile, chunk_range, kmers, count_backend, num_cores,
+                                                              spill, sketch, checkpoints, count_keys[ichunk])
+            record.update(records=num_sequences, bases=num_bases)
+        count_inputs.append((inputfile, chunk_range, count_keys[ichunk]))
+
+        print("Number of sequences in " + inputfile + " = "+ str(humanize.intword(num_sequences)))
+
+        if sketch is not None: print("Time to sketch " + kmerstring_all +  ": " + str(round(timeit.default_timer() - start_time,2)) + " secs")
+        else: print("Time to compute " + kmerstring_all +  ": " + str(round(timeit.default_timer() - start_time,2)) + " secs")
+
+        #chunk tables are merged raw, -c and the k-mer properties are applied once to the merged table
+        if sample_table is None: sample_table = kmertable
+        else:
+            with report.stage('merge', sample=sample_name, chunk=ichunk):
+                sample_table = merge_counts([sample_table, kmertable], count_backend)
+        del kmertable
+
+        # dfcol = significant_kmers
+        #
+        #
+        # if not mflag_protein:
+        #     dfcol.extend(["length","GC_Percent","AT_Percent"])
+        #
+        #     df = pd.DataFrame(0,index=list(sequences.keys()),columns=dfcol)
+        #
+        #     for seq in sequences:
+        #         cseq = sequences[seq]
+        #         len_cseq = float(len(cseq))
+        #         df.set_value(seq, "length", int(len_cseq))
+        #         df.set_value(seq, "GC_Percent", round(((cseq.count("G")+cseq.count("C")) / len_cseq) * 100.0))
+        #         df.set_value(seq, "AT_Percent", round(((cseq.count("A")+cseq.count("T")) / len_cseq) * 100.0))
+        #         for ss in kmerlist_all_seq[seq]:
+        #             df.set_value(seq, ss, kmerlist_all_seq[seq][ss])
+        #
+        #         #df = df.loc[:, df.max() >= prune_kmer]
+        #         df1 = df.ix[:,['length','GC_Percent','AT_Percent']]
+        #         del df['length']
+        #         del df['GC_Percent']
+        #         del df['AT_Percent']
+        #         df = df.loc[:, df.max() >= prune_kmer]
+        #         df.loc[:, 'length'] = df1.ix[:,'length']
+        #         df.loc[:, 'GC_Percent'] = df1.ix[:,'GC_Percent']
+        #         df.loc[:, 'AT_Percent'] = df1.ix[:,'AT_Percent']
+        #
+        #
+        # else:
+        #
+        #     dfcol.extend(["length", "PI", "MW","Hydro"])
+        #
+        #     df = pd.DataFrame(0, index=list(sequences.keys()), columns=dfcol)
+        #
+        #     for seq in sequences:
+        #         cseq = sequences[seq]
+        #         cseq=cseq.replace('*','')
+        #         len_cseq = float(len(cseq))
+        #         df.set_value(seq, "length", int(len_cseq))
+        #         df.set_value(seq, "PI", predict_isoelectric_point_ProMoST(cseq))
+        #         df.set_value(seq, "MW", calculate_MW(cseq))
+        #         df.set_value(seq, "Hydro", calculate_hydro(cseq))
+        #         for ss in kmerlist_all_seq[seq]:
+        #             df.set_value(seq, ss, kmerlist_all_seq[seq][ss])
+        #
+        #         #df = df.loc[:,df.max() >= prune_kmer]
+        #         df1 = df.ix[:,['length','PI','MW','Hydro']]
+        #         del df['length']
+        #         del df['PI']
+        #         del df['MW']
+        #         del df['Hydro']
+        #         df = df.loc[:, df.max() >= prune_kmer]
+        #         df.loc[:, 'length'] = df1.ix[:,'length']
+        #         df.loc[:, 'PI'] = df1.ix[:,'PI']
+        #         df.loc[:, 'MW'] = df1.ix[:,'MW']
+        #         df.loc[:, 'Hydro'] = df1.ix[:, 'Hydro']
+        #
+        # df.to_csv(bif+".csv",index_label='Sequence',index=True)
+
+        print("Total time: " + str(round(timeit.default_timer() - start_time,2)) + " secs")
+
+
+    if sketch_built:
+        for k, sk, fn in zip(kmers, sketch, sketch_files):
+            sk.save(fn)
+            print("Prefilter sketch for " + kmerstrings[k] + ": " + str(sketch_depth) + " x " + str(sk.width) + " cells, " +
+                  str(round(100 * sk.fill_ratio(), 1)) + "% of them can reach count " + str(prune_kmer))
+        start_time = timeit.default_timer()
+        sample_table = merge_counts([], count_backend)
+        for ichunk, (inputfile, chunk_range, key) in enumerate(count_inputs):
+            with report.stage('count', sample=sample_name, chunk=ichunk, prefiltered=True,
+                              bytes=range_size(chunk_range, os.stat(inputfile).st_size)) as record:
+                kmertable, record['records'], record['bases'] = count_chunk(inputfile, chunk_range, kmers, count_backend, num_cores,
+                                                                            spill, sketch, checkpoints, key)
+            with report.stage('merge', sample=sample_name, chunk=ichunk):
+                sample_table = merge_counts([sample_table, kmertable], count_backend)
+            del kmertable
+        print("Time to compute " + kmerstring_all +  ": " + str(round(timeit.default_timer() - start_time,2)) + " secs")
+    if sketch is not None:
+        for sk in sketch: os.remove(sk.path)
+
+    if sample_table is None: sample_table = merge_counts([], count_backend)
+    sample_table = list(sample_table)
+
+    for i, kmer in enumerate(kmers):
+        kmerstring = kmerstrings[kmer]
+        #with several k values every output file carries the k-mer length
+        basename_k = os.path.join(dir_runs, basename_ipfile + "_" + kmerstring if multi_k else basename_ipfile)
+        metadata = table_metadata(kmer, np_string, prune_kmer, sample_name)
+        #with -mode disk the summary stage also writes the table, a bucket at a time
+        with report.stage('summary', sample=sample_name, k=kmer, spilled=spill is not None) as record:
+            if spill is not None:
+                #each bucket is counted, summarized and written on its own
+                writer = CountTableWriter(basename_k + "_summary", __args__.fmt, kmerstring, metadata, __args__.compress)
+                df10, total_count, all_keys, all_counts, num_kmers = summarize_spilled_counts(spill[i], prune_kmer, mflag_protein,
+                                                                                              writer, num_cores, property_caches[kmer])
+                spill[i].remove()
+                if __args__.fmt == 'csv': link_final_summary(writer.fn, basename_k)
+                num_significant = len(all_counts)
+                if save_vectors: vectors[kmer] = save_kmer_vector(basename_k + "_vector", all_keys, all_counts)
+                del all_keys
+            else:
+                if save_vectors:
+                    keys, counts = table_arrays(sample_table[i], count_backend[i], kmer)
+                    significant = counts >= prune_kmer
+                    vectors[kmer] = save_kmer_vector(basename_k + "_vector", keys[significant], counts[significant])
+                    del keys, counts
+                df, num_kmers = summarize_counts(sample_table[i], count_backend[i], kmer, prune_kmer, mflag_protein,
+                                                 property_caches[kmer])
+                with report.stage('write', sample=sample_name, k=kmer, kmers=len(df)):
+                    summary_file = write_count_table(df, basename_k + "_summary", __args__.fmt, kmerstring, metadata,
+                                                     __args__.compress)
+                    if __args__.fmt == 'csv': link_final_summary(summary_file, basename_k)
+                #top 10, totals and diversity all come from the one merged table
+                df10 = df.nlargest(10,'Count')
+                total_count = df.Count.sum()
+                all_counts = df.Count.values
+                num_significant = len(df)
+                del df
+            record.update(kmers=int(num_kmers), significant=int(num_significant), kmer_total=int(total_count))
+        sample_table[i] = None
+
+        if sketch is not None: print("Number of " + kmerstring +  " admitted by the prefilter: " + str(humanize.intword(num_kmers)))
+        else: print("Total number of " + kmerstring +  " found: " + str(humanize.intword(num_kmers)))
+        print(kmerstring +  " with count >= " + str(prune_kmer) + ": " + str(humanize.intword(num_significant)))
+
+        top10[kmer] = [df10,total_count]
+
+        with report.stage('diversity', sample=sample_name, k=kmer, kmers=int(num_significant)):
+            mercat_compute_alpha_beta_diversity(all_counts.astype(int),basename_k)
+    del sample_table
+
+    #the sample is complete, its checkpoints are not needed any more
+    if checkpoints is not None: checkpoints.remove()
+
+    cache_stats = dict()
+    for k in cache_start:
+        property_cache = property_caches[k]
+        cache_stats[k] = (property_cache.hits - cache_start[k][0], property_cache.misses - cache_start[k][1])
+        if save_caches: property_cache.save()
+
+    return sample_name, top10, cache_stats, vectors
+
+def top_sample(m_inputfile,results_dir,__args__,num_cores,property_caches,report,save_caches=False):
+    '''
+    mercat_sample for -top N: the N most frequent k-mers per k without the
+    full count table. A first pass keeps a bounded Space-Saving summary
+    (see heavyhitters) of every batch and merges them; its candidates for
+    the top N are then counted exactly in a second pass over the input (or
+    the tool output). Writes the top N table and returns the top 10 for the
+    plots; there is no diversity and no k-mer vector.
+    '''
+    kmers = tuple(__args__.k)
+    topn = __args__.top
+    prune_kmer = __args__.c
+    capacity = summary_capacity(topn)
+
+    np_string = "nucleotide"
+    if __args__.pro or __args__.p: np_string = "protein"
+    mflag_protein = np_string == "protein"
+
+    kmerstrings = dict((k, str(k) + "-mers") for k in kmers)
+    kmerstring_all = ",".join(str(k) for k in kmers) + "-mers"
+    multi_k = len(kmers) > 1
+
+    count_backend = tuple(select_backend(__args__.b, k, mflag_protein) for k in kmers)
+    cache_start = dict((k, (c.hits, c.misses)) for k, c in property_caches.items() if c is not None)
+
+    m_inputfile = os.path.abspath(m_inputfile)
+    sample_name = os.path.splitext(os.path.basename(strip_compression_ext(m_inputfile)))[0]
+    basename_ipfile = sample_name + "_" + np_string
+    dir_runs = os.path.join(results_dir, basename_ipfile + "_run")
+    if os.path.exists(dir_runs): shutil.rmtree(dir_runs)
+    os.makedirs(dir_runs)
+
+    print("Running mercat using " + str(num_cores) + " cores")
+    print("input file: " + m_inputfile)
+    print("Finding the top " + str(topn) + " " + kmerstring_all + " with summaries of " + str(humanize.intword(capacity)) + " k-mers")
+
+    with Parallel(n_jobs=num_cores) as parallel:
+        start_time = timeit.default_timer()
+        #first pass: merged summaries; the tool output is kept for the second pass
+        with report.stage('summarize', sample=sample_name, bytes=os.stat(m_inputfile).st_size, capacity=capacity) as record:
+            if __args__.t or __args__.p:
+                tool_jobs = tool_chunk_jobs(m_inputfile, __args__, num_cores, dir_runs, sample_name, np_string)
+                print(tool_pipeline(tool_jobs[0][2], __args__.t, __args__.p))
+                count_inputs = [tool_output_file(bif, trim_window, gene_calls) for _, _, bif, trim_window, gene_calls, _ in tool_jobs]
+                input_bases = os.stat(m_inputfile).st_size * (4 if compression_of(m_inputfile) else 1)
+                batches = batch_sequences(tool_stage_sequences(tool_jobs, num_cores), batch_size_bases(input_bases, num_cores))
+                tasks = (delayed(topBatchTask)(batch, kmers, count_backend, capacity) for batch in batches)
+            else:
+                count_inputs = [m_inputfile]
+                tasks = input_tasks(m_inputfile, topRangeTask, topBatchTask, (kmers, count_backend, capacity), num_cores)
+            summaries, num_sequences, num_bases = fold_top_rounds(tasks, num_cores, capacity, parallel)
+            #an input without sequences has empty summaries
+            if summaries is None: summaries = topBatchTask([], kmers, count_backend, capacity)[0]
+            record.update(records=num_sequences, bases=num_bases)
+        print("Number of sequences in " + m_inputfile + " = " + str(humanize.intword(num_sequences)))
+        print("Time to summarize " + kmerstring_all + ": " + str(round(timeit.default_timer() - start_time,2)) + " secs")
+
+        #second pass: exact counts of the candidates
+        start_time = timeit.default_timer()
+        candidates = tuple(summary.candidates(topn) for summary in summaries)
+        with report.stage('verify', sample=sample_name, candidates=sum(len(c) for c in candidates)) as record:
+            candidate_total = None
+            record['records'] = record['bases'] = 0
+            for fn in count_inputs:
+                tasks = input_tasks(fn, topRangeTask, topBatchTask, (kmers, count_backend, capacity, candidates), num_cores)
+                counts, nseqs, nbases = fold_top_rounds(tasks, num_cores, capacity, parallel)
+                record['records'] += nseqs
+                record['bases'] += nbases
+                if counts is None: continue
+                candidate_total = counts if candidate_total is None else tuple(a + b for a, b in zip(candidate_total, counts))
+        print("Time to verify " + kmerstring_all + ": " + str(round(timeit.default_timer() - start_time,2)) + " secs")
+
+    top10 = dict()
+    for i, kmer in enumerate(kmers):
+        kmerstring = kmerstrings[kmer]
+        summary = summaries[i]
+        counts = candidate_total[i] if candidate_total is not None else np.zeros(len(candidates[i]), dtype=np.int64)
+        keys, counts = top_counts(candidates[i], counts, topn)
+        exact = is_exact(counts, topn, summary.floor)
+        significant = counts >= prune_kmer
+        keys, counts = keys[significant], counts[significant]
+
+        basename_k = os.path.join(dir_runs, basename_ipfile + "_" + kmerstring if multi_k else basename_ipfile)
+        df = summary_frame(keys, counts, kmer, mflag_protein, property_caches[kmer])
+        with report.stage('write', sample=sample_name, k=kmer, kmers=len(df)):
+            write_count_table(df, basename_k + "_top" + str(topn), __args__.fmt, kmerstring,
+                              table_metadata(kmer, np_string, prune_kmer, sample_name), __args__.compress)
+
+        print("Top " + str(topn) + " " + kmerstring + " out of " + str(len(candidates[i])) + " candidates: " +
+              ("exact" if exact else "may miss k-mers with count <= " + str(summary.floor) + ", rerun with a larger -top for an exact top " + str(topn)))
+        print(kmerstring + " with count >= " + str(prune_kmer) + " in the top " + str(topn) + ": " + str(humanize.intword(len(df))))
+
+        #-top has no table of the significant k-mers to total, the bar chart shares are of all k-mers counted
+        top10[kmer] = [df.nlargest(10,'Count'), summary.total]
+
+    cache_stats = dict()
+    for k in cache_start:
+        property_cache = property_caches[k]
+        cache_stats[k] = (property_cache.hits - cache_start[k][0], property_cache.misses - cache_start[k][1])
+        if save_caches: property_cache.save()
+
+    return sample_name, top10, cache_stats, dict()
+
+
+def schedule_samples(ipfiles,num_cores):
+    '''
+    (input file, cores) for every input, largest first. The cores are shared
+    in proportion to the (uncompressed) input size, so large samples get
+    more of them and small ones get one each and are packed side by side;
+    no sample gets more cores than it has counting batches.
+    '''
+    sizes = dict((f, os.stat(f).st_size * (4 if compression_of(f) else 1)) for f in ipfiles)
+    total = max(sum(sizes.values()), 1)
+    jobs = []
+    for f in sorted(ipfiles, key=lambda f: -sizes[f]):
+        cores = int(round(num_cores * float(sizes[f]) / total))
+        cores = max(1, min(cores, num_cores, -(-sizes[f] // min_batch_bases)))
+        jobs.append((f, cores))
+    return jobs
+
+def sampleTask(*args):
+    '''mercat_sample in a sample worker process. Its joblib pool is shut down before the next sample,
+    a worker exiting with idle joblib workers left would block the shutdown of the sample pool.
+    One-core samples run without a joblib pool at all.'''
+    try:
+        return mercat_sample(*args)
+    finally:
+        if args[3] > 1:
+            #a failed shutdown must not replace the sample's result or error
+            try:
+                from joblib.externals.loky import get_reusable_executor
+                get_reusable_executor(reuse=True).shutdown(wait=True, kill_workers=True)
+            except Exception as e:
+                print("Mercat Warning: could not shut down the joblib workers of " + args[0] + ": " + str(e))
+
+def run_samples(jobs,results_dir,__args__,num_cores,memory_budget,property_caches,concurrent):
+    '''
+    Run mercat_sample for every (input file, cores) job and yield the results.
+    Concurrently, the largest pending samples that fit in the free cores are
+    started in worker processes, each with its own joblib pool, core budget
+    and share of the memory budget; the workers save the property caches.
+    '''
+    if not concurrent:
+        for ipfile, _ in jobs:
+            yield mercat_sample(ipfile, results_dir, __args__, num_cores, memory_budget, property_caches)
+        return
+
+    free = num_cores
+    pending = list(jobs)
+    running = dict()
+    #spawned workers exit through the interpreter's exit handlers, which is where joblib
+    #deletes the memmapping folders of their pools (forked workers skip them)
+    with ProcessPoolExecutor(max_workers=num_cores, mp_context=multiprocessing.get_context('spawn')) as executor:
+        while pending or running:
+            for job in list(pending):
+                ipfile, cores = job
+                if cores > free: continue
+                pending.remove(job)
+                free -= cores
+                future = executor.submit(sampleTask, ipfile, results_dir, __args__, cores,
+                                         memory_budget * cores // num_cores, property_caches, True)
+                running[future] = cores
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                free += running.pop(future)
+                yield future.result()
+
+
+def mercat_sample_matrix(vectors,results_dir,kmer,kmerstring,np_string,prune_kmer,num_cores):
+    '''Sparse sample x k-mer matrix of a folder run and the Bray-Curtis and Jaccard distances between its samples'''
+    start_time = timeit.default_timer()
+    sample_names = sorted(vectors)
+    path_base = os.path.join(results_dir, "samples_" + np_string + "_" + kmerstring)
+    with Parallel(n_jobs=num_cores) as parallel:
+        matrix, vocabulary = build_sample_matrix([vectors[s] for s in sample_names], kmer, num_cores, parallel)
+        save_sample_matrix(path_base, matrix, vocabulary, sample_names,
+                           table_metadata(kmer, np_string, prune_kmer, None))
+        print("Sample x " + kmerstring + " matrix: " + str(matrix.shape[0]) + " samples, " +
+              str(humanize.intword(matrix.shape[1])) + " " + kmerstring + ", " + str(humanize.intword(matrix.nnz)) + " counts")
+        braycurtis, jaccard = beta_diversity(matrix, num_cores, parallel)
+    write_distance_matrix(path_base + "_braycurtis.tsv", braycurtis, sample_names)
+    write_distance_matrix(path_base + "_jaccard.tsv", jaccard, sample_names)
+    print("Time to compute the beta diversity of " + kmerstring + ": " + str(round(timeit.default_timer() - start_time,2)) + " secs")
+
+
+def mercat_store(store,vectors,top10,kmer,kmerstring,is_protein,property_cache):
+    '''
+    Add the samples of this run to the k-mer store and refresh the cohort summary
+    of the store (top 10 k-mers and diversity) kept in its folder
+    '''
+    start_time = timeit.default_timer()
+    with store.locked():
+        for sample_name in sorted(vectors):
+            store.add_sample(sample_name, vectors[sample_name], top10[sample_name][0], top10[sample_name][1])
+        keys, counts = store.top()
+        df = summary_frame(keys, counts, kmer, is_protein, property_cache)
+        df.to_csv(os.path.join(store.directory, "cohort_summary_top10.csv"), index_label=kmerstring)
+        #the histogram of cohort counts gives the diversity without reading, or expanding to, the k-mers
+        values, freqs = store.histogram(store.manifest['min_count'])
+        if len(values):
+            mercat_compute_alpha_diversity_histogram(values, freqs, os.path.join(store.directory, "cohort"))
+        print("Store " + store.directory + ": " + str(len(store.manifest['samples'])) + " samples, " +
+              str(humanize.intword(store.manifest['total'])) + " " + kmerstring + " counted")
+        sample_tops = store.sample_tops()
+    print("Time to update the " + kmerstring + " store: " + str(round(timeit.default_timer() - start_time,2)) + " secs")
+    return sample_tops
+
+
 def mercat_main():
     __args__, m_parser = parseargs()
+    start_time = timeit.default_timer()
 
-    kmer = __args__.k
+    kmers = tuple(__args__.k)
     num_cores = __args__.n
     m_inputfile = __args__.i
     m_inputfolder = __args__.f
-    prune_kmer = __args__.c
-    mflag_fastq = __args__.q
-    mflag_prodigal = __args__.p
-    mflag_trimmomatic = __args__.t
-    mflag_protein = __args__.pro
-    mfile_size_split = __args__.s
 
-    kmerstring = str(kmer) + "-mers"
-
-    if not mfile_size_split:
-        mfile_size_split = 100
+    kmerstrings = dict((k, str(k) + "-mers") for k in kmers)
+    multi_k = len(kmers) > 1
 
     np_string = "nucleotide"
-    if mflag_protein or mflag_prodigal: np_string = "protein"
+    if __args__.pro or __args__.p: np_string = "protein"
     def_option =  not __args__.p and not __args__.q and not __args__.pro
 
+    memory_budget = psutil.virtual_memory().available // 2
+    if __args__.mem: memory_budget = __args__.mem * 1024 * 1024
+
+    #PI, MW and Hydro are computed once per residue composition for all chunks and samples
+    property_caches = dict((k, None) for k in kmers)
+    if np_string == "protein":
+        for k in kmers:
+            cache_file = None
+            if __args__.cache:
+                cache_file = os.path.join(os.path.abspath(__args__.cache), "protein_properties_" + kmerstrings[k] + ".pkl")
+            property_caches[k] = PropertyCache(path=cache_file)
+
     all_ipfiles = []
     if m_inputfolder:
         m_inputfolder = os.path.abspath(m_inputfolder)
-        os.chdir(m_inputfolder)
         #Assume all have same ext
         for fname in os.listdir(m_inputfolder):
             mip = os.path.join(m_inputfolder, fname)
@@ -188,317 +1222,98 @@ def mercat_main():
         m_inputfolder = os.path.dirname(os.path.abspath(m_inputfile))
         all_ipfiles.append(os.path.abspath(m_inputfile))
 
-    top10_all_samples = dict()
     for m_inputfile in all_ipfiles:
-
-        os.chdir(m_inputfolder)
         check_args(m_inputfile,__args__,def_option,m_parser)
 
-        m_inputfile = os.path.abspath(m_inputfile)
-
-        sample_name = os.path.splitext(os.path.basename(m_inputfile))[0]
-        basename_ipfile = os.path.splitext(os.path.basename(m_inputfile))[0] + "_" + np_string
-
-        inputfile_size = os.stat(m_inputfile).st_size
-        dir_runs = "mercat_results/" + basename_ipfile + "_run"
-
-        if os.path.exists(dir_runs):
-            shutil.rmtree(dir_runs)
-        os.makedirs(dir_runs)
-
-        all_chunks_ipfile = []
-        is_chunked = False
-        if inputfile_size >= (mfile_size_split*1024*1024): #100MB
-            print("Large input file provided: Splitting it into smaller files...\n")
-            mercat_chunker(m_inputfile,dir_runs,str(mfile_size_split)+"M",">")
-            os.chdir(dir_runs)
-            all_chunks_ipfile = glob.glob("*")
-            is_chunked=True
-        else:
-            os.chdir(dir_runs)
-            all_chunks_ipfile.append(m_inputfile)
-
-        #print all_chunks_ipfile
-        #sys.exit(1)
-
-
-        splitSummaryFiles = []
-
-        for inputfile in all_chunks_ipfile:
-
-            bif = os.path.splitext(os.path.basename(inputfile))[0] + "_" + np_string
-
-            '''trimmomatic SE -phred33 test.fq Out.fastq ILLUMINACLIP:TruSeq2-SE.fa:2:30:10 LEADING:3 TRAILING:3 SLIDINGWINDOW:4:30 MINLEN:50'''
-            if mflag_trimmomatic:
-                swq = mflag_trimmomatic
-                trimmed_file = bif+"_trimmed.fq"
-                prod_cmd = "trimmomatic SE -phred33 %s %s ILLUMINACLIP:TruSeq2-SE.fa:2:30:10 LEADING:3 TRAILING:3 SLIDINGWINDOW:4:%s MINLEN:50" %(inputfile,trimmed_file,swq)
-                with open(os.devnull, 'w') as FNULL:
-                    subprocess.call(prod_cmd, stdout=FNULL, stderr=FNULL, shell=True)
-                inputfile = trimmed_file
-
-            "Run prodigal if specified"
-            '''prodigal -i test_amino-acid.fa -o output.gff -a output.orf_pro.faa  -f gff -p meta -d output.orf_nuc'''
-            if mflag_prodigal:
-                mflag_protein = True
-                gen_protein_file = bif+"_pro.faa"
-                prod_cmd = "prodigal -i %s -o %s -a %s -f gff -p meta -d %s" % (
-                inputfile, bif + ".gff", gen_protein_file, bif + "_nuc.ffn")
-
-                if mflag_fastq and mflag_trimmomatic:
-                    trimfna = bif + "_trimmed.fna"
-                    sequences = OrderedDict()
-                    with open(inputfile, 'r') as f:
-                        seq = ""
-                        sname = ""
-                        for line in f:
-                            line = line.strip()
-                            if line.startswith("@"):
-                                sname = line[1:].split()[0]
-                            elif line.startswith("+"):
-                                if seq:
-                                    sequences[sname] = seq
-                                    seq = ""
-                            else:
-                                if sname not in sequences: seq = line
-
-                    fnastring = ""
-
-                    for sname in sequences:
-                        fnastring += ">"+sname+"\n"
-                        fnastring += sequences[sname]+"\n"
-
-                    with open(trimfna, 'w') as f: f.write(fnastring)
-
-                    gen_protein_file = bif + "_trimmed_pro.faa"
-                    prod_cmd = "prodigal -i %s -o %s -a %s -f gff -p meta -d %s" % (
-                    trimfna, bif + ".gff", gen_protein_file, bif + "_nuc.ffn")
-
-                print(prod_cmd)
-                with open(os.devnull, 'w') as FNULL:
-                    subprocess.call(prod_cmd, stdout=FNULL, stderr=FNULL, shell=True)
-                inputfile = gen_protein_file
-
-            print("Running mercat using " + str(num_cores) + " cores")
-            print("input file: " + inputfile)
-
-            sequences = OrderedDict()
-            is_fastq = False
-
-
-            start_time = timeit.default_timer()
-
-
-            with open(inputfile,'r') as f:
-                for line in f:
-                    if line.startswith(">"): break
-                    elif line.startswith("@"):
-                        is_fastq = True
-                        break
-
-
-
-            with open(inputfile,'r') as f:
-                if not is_fastq:
-                    seq = ""
-                    sname = ""
-                    for line in f:
-                        line = line.strip()
-                        if line.startswith(">"):
-                            if sname: sequences[sname] = ""
-                            if seq:
-                                sequences[sname] = seq
-                                seq = ""
-                            sname = line[1:]
-                            sname = sname.split("#",1)[0].strip()
-                        else:
-                            line = line.replace("*","")
-                            seq += line
-
-                    #assert sname and seq
-                    sequences[sname] = seq
-
-                else: #process fastq file
-                    seq = ""
-                    sname = ""
-                    for line in f:
-                        line = line.strip()
-                        if line.startswith("@"):
-                            sname = line[1:].split()[0]
-                        elif line.startswith("+"):
-                            if seq:
-                                sequences[sname] = seq
-                                seq = ""
-                        else:
-                            if sname not in sequences: seq = line
-
-
-            #print sequences.keys()[0] + "="+ sequences.values()[0]
-
-            print("Number of sequences in " + inputfile + " = "+ str(humanize.intword(len(sequences))))
-
-
-            # results = Parallel(n_jobs=num_cores)(
-            #     delayed(calculateKmerCount)(seq, sequences[seq], prune_kmer, kmer) for seq in sequences)
-            results = Parallel(n_jobs=num_cores)(
-                delayed(calculateKmerCount)(sequences[seq], kmer) for seq in sequences)
-
-
-            kmerlist = dict()
-            #kmerlist_all_seq = dict()
-
-            for d in results:
-                for k,v in list(d.items()):
-                    if k in kmerlist:
-                        kmerlist[k] += v
-                    else: kmerlist[k] = v
-
-            # for d in results:
-            #     for seq,kdict in list(d[1].items()):
-            #         #assert seq not in kmerlist_all_seq
-            #         kmerlist_all_seq[seq] = kdict#.copy()
-
-            print("Time to compute " + kmerstring +  ": " + str(round(timeit.default_timer() - start_time,2)) + " secs")
-
-            significant_kmers = []
-            for k in kmerlist:
-                if kmerlist[k] >= prune_kmer: significant_kmers.append(k)
-
-            print("Total number of " + kmerstring +  " found: " + str(humanize.intword(len(kmerlist))))
-            print(kmerstring +  " with count >= " + str(prune_kmer) + ": " + str(humanize.intword(len(significant_kmers))))
-
-            #df = df.ix[df[bif] >= prune_kmer]
-
-
-            if mflag_protein:
-                df = pd.DataFrame(0.0, index=significant_kmers, columns=['Count',"PI","MW","Hydro"])
-                for k in significant_kmers:
-                    df.set_value(k, 'Count', kmerlist[k])
-                    df.set_value(k,"PI", predict_isoelectric_point_ProMoST(k))
-                    df.set_value(k, "MW", calculate_MW(k))
-                    df.set_value(k, "Hydro", calculate_hydro(k))
-
-                df.to_csv(bif + "_summary.csv", index_label=kmerstring, index=True)
-            else:
-                df = pd.DataFrame(0, index=significant_kmers, columns=['Count',"GC_Percent","AT_Percent"])
-                for k in significant_kmers:
-                    c_kmer = k
-                    df.set_value(k, 'Count', kmerlist[k])
-                    len_cseq = float(len(c_kmer))
-                    df.set_value(k, "GC_Percent", round(((c_kmer.count("G")+c_kmer.count("C")) / len_cseq) * 100.0))
-                    df.set_value(k, "AT_Percent", round(((c_kmer.count("A")+c_kmer.count("T")) / len_cseq) * 100.0))
-
-                df.to_csv(bif + "_summary.csv", index_label=kmerstring, index=True)
-
-            splitSummaryFiles.append(bif + "_summary.csv")
-
-            # dfcol = significant_kmers
-            #
-            #
-            # if not mflag_protein:
-            #     dfcol.extend(["length","GC_Percent","AT_Percent"])
-            #
-            #     df = pd.DataFrame(0,index=list(sequences.keys()),columns=dfcol)
-            #
-            #     for seq in sequences:
-            #         cseq = sequences[seq]
-            #         len_cseq = float(len(cseq))
-            #         df.set_value(seq, "length", int(len_cseq))
-            #         df.set_value(seq, "GC_Percent", round(((cseq.count("G")+cseq.count("C")) / len_cseq) * 100.0))
-            #         df.set_value(seq, "AT_Percent", round(((cseq.count("A")+cseq.count("T")) / len_cseq) * 100.0))
-            #         for ss in kmerlist_all_seq[seq]:
-            #             df.set_value(seq, ss, kmerlist_all_seq[seq][ss])
-            #
-            #         #df = df.loc[:, df.max() >= prune_kmer]
-            #         df1 = df.ix[:,['length','GC_Percent','AT_Percent']]
-            #         del df['length']
-            #         del df['GC_Percent']
-            #         del df['AT_Percent']
-            #         df = df.loc[:, df.max() >= prune_kmer]
-            #         df.loc[:, 'length'] = df1.ix[:,'length']
-            #         df.loc[:, 'GC_Percent'] = df1.ix[:,'GC_Percent']
-            #         df.loc[:, 'AT_Percent'] = df1.ix[:,'AT_Percent']
-            #
-            #
-            # else:
-            #
-            #     dfcol.extend(["length", "PI", "MW","Hydro"])
-            #
-            #     df = pd.DataFrame(0, index=list(sequences.keys()), columns=dfcol)
-            #
-            #     for seq in sequences:
-            #         cseq = sequences[seq]
-            #         cseq=cseq.replace('*','')
-            #         len_cseq = float(len(cseq))
-            #         df.set_value(seq, "length", int(len_cseq))
-            #         df.set_value(seq, "PI", predict_isoelectric_point_ProMoST(cseq))
-            #         df.set_value(seq, "MW", calculate_MW(cseq))
-            #         df.set_value(seq, "Hydro", calculate_hydro(cseq))
-            #         for ss in kmerlist_all_seq[seq]:
-            #             df.set_value(seq, ss, kmerlist_all_seq[seq][ss])
-            #
-            #         #df = df.loc[:,df.max() >= prune_kmer]
-            #         df1 = df.ix[:,['length','PI','MW','Hydro']]
-            #         del df['length']
-            #         del df['PI']
-            #         del df['MW']
-            #         del df['Hydro']
-            #         df = df.loc[:, df.max() >= prune_kmer]
-            #         df.loc[:, 'length'] = df1.ix[:,'length']
-            #         df.loc[:, 'PI'] = df1.ix[:,'PI']
-            #         df.loc[:, 'MW'] = df1.ix[:,'MW']
-            #         df.loc[:, 'Hydro'] = df1.ix[:, 'Hydro']
-            #
-            # df.to_csv(bif+".csv",index_label='Sequence',index=True)
-
-            print("Total time: " + str(round(timeit.default_timer() - start_time,2)) + " secs")
-
-
-        num_chunks = len(all_chunks_ipfile)
-        df = dd.read_csv(splitSummaryFiles)
-        dfgb = df.groupby(kmerstring).sum()
-        df10 = dfgb.nlargest(10,'Count').compute()
-        dfsum = dfgb.sum(0).compute()
-
-        dfgb.to_csv("./" + basename_ipfile + "_finalSummary*.csv", index_label=kmerstring, name_function=name)
-
-        if mflag_protein:
-            df10[['PI', 'MW', 'Hydro']] = df10[['PI', 'MW', 'Hydro']] / num_chunks
-        else:
-            df10[['GC_Percent', 'AT_Percent']] = df10[['GC_Percent', 'AT_Percent']] / num_chunks
-
-        top10_all_samples[sample_name] = [df10,dfsum.Count]
-
-        all_counts = dfgb.Count.values.compute().astype(int)
-        mercat_compute_alpha_beta_diversity(all_counts,basename_ipfile)
-
-        if is_chunked:
-            for tempfile in all_chunks_ipfile:
-                os.remove(tempfile)
-            for sf in splitSummaryFiles:
-                os.remove(sf)
-
-    plots_dir = m_inputfolder+"/mercat_results/plots"
+    #the stores are opened before counting, so samples never get counted for a store that cannot take them
+    stores = dict()
+    if __args__.store:
+        for kmer in kmers:
+            stores[kmer] = KmerStore(os.path.join(os.path.abspath(__args__.store), store_name(kmer, np_string)),
+                                     kmer, np_string, __args__.c)
+            mismatch = stores[kmer].check(kmer, np_string, __args__.c)
+            if mismatch:
+                print("Mercat Error: " + mismatch)
+                sys.exit(1)
+
+    results_dir = os.path.join(m_inputfolder, "mercat_results")
+    jobs = schedule_samples(all_ipfiles, num_cores)
+    concurrent = len(jobs) > 1 and num_cores > 1
+    if concurrent:
+        print("Running " + str(len(jobs)) + " samples concurrently on " + str(num_cores) + " cores")
+
+    #stages of the samples are recorded where they run, the folder-level stages here
+    report = RunReport(load_hook(__args__.hook) if __args__.hook else None)
+    top10_all_samples = dict((k, dict()) for k in kmers)
+    vectors_all_samples = dict((k, dict()) for k in kmers)
+    cache_stats = dict((k, [0, 0]) for k in kmers)
+    for sample_name, top10, stats, vectors, records in run_samples(jobs, results_dir, __args__, num_cores, memory_budget,
+                                                                   property_caches, concurrent):
+        report.extend(records)
+        for kmer in kmers: top10_all_samples[kmer][sample_name] = top10[kmer]
+        for kmer in vectors: vectors_all_samples[kmer][sample_name] = vectors[kmer]
+        for kmer in stats:
+            cache_stats[kmer][0] += stats[kmer][0]
+            cache_stats[kmer][1] += stats[kmer][1]
+
+    for kmer in kmers:
+        property_cache = property_caches[kmer]
+        if property_cache is not None:
+            print("Protein property cache for " + kmerstrings[kmer] + ": " + str(cache_stats[kmer][0]) + " hits, " +
+                  str(cache_stats[kmer][1]) + " misses")
+            if not concurrent: property_cache.save()
+
+    #-top runs keep no k-mer vectors, there is no sample x k-mer matrix
+    if len(all_ipfiles) > 1 and not __args__.top:
+        for kmer in kmers:
+            with report.stage('matrix', k=kmer, samples=len(vectors_all_samples[kmer])):
+                mercat_sample_matrix(vectors_all_samples[kmer], results_dir, kmer, kmerstrings[kmer], np_string,
+                                     __args__.c, num_cores)
+
+    #the stacked bar plot then shows every sample in the store, not only the ones of this run
+    stackedbar_samples = dict(top10_all_samples)
+    for kmer in stores:
+        with report.stage('store', k=kmer, samples=len(vectors_all_samples[kmer])):
+            stackedbar_samples[kmer] = mercat_store(stores[kmer], vectors_all_samples[kmer], top10_all_samples[kmer], kmer,
+                                                   kmerstrings[kmer], np_string == "protein", property_caches[kmer])
+
+    for kmer in kmers:
+        for vector in vectors_all_samples[kmer].values():
+            for ext in (".keys.npy", ".counts.npy"): os.remove(vector + ext)
+
+    plots_dir = results_dir + "/plots"
     if os.path.exists(plots_dir):
         shutil.rmtree(plots_dir)
-    os.makedirs(plots_dir)
-    os.chdir(plots_dir)
-
-    for basename_ipfile in top10_all_samples:
-        df10,_ = top10_all_samples[basename_ipfile]
-        if mflag_protein:
-            mercat_scatter_plots(basename_ipfile, 'PI', df10, kmerstring)
-            mercat_scatter_plots(basename_ipfile, 'MW', df10, kmerstring)
-            mercat_scatter_plots(basename_ipfile, 'Hydro', df10, kmerstring)
-        else:
-            mercat_scatter_plots(basename_ipfile, 'GC_Percent', df10, kmerstring)
-            mercat_scatter_plots(basename_ipfile, 'AT_Percent', df10, kmerstring)
 
     sbname = os.path.basename(m_inputfolder)
     if len(all_ipfiles) == 1: sbname = os.path.basename(all_ipfiles[0])
-    mercat_stackedbar_plots(sbname,top10_all_samples, 'Count', kmerstring)
 
+    #the report is written even when a plot fails, it shows how far the run got
+    report_file = os.path.join(results_dir, "mercat_report.json")
+    try:
+        for kmer in kmers:
+            kmerstring = kmerstrings[kmer]
+            kmer_plots_dir = plots_dir + "/" + kmerstring if multi_k else plots_dir
+            os.makedirs(kmer_plots_dir)
+            with report.stage('plots', k=kmer, samples=len(top10_all_samples[kmer])):
+                for basename_ipfile in top10_all_samples[kmer]:
+                    df10,_ = top10_all_samples[kmer][basename_ipfile]
+                    if np_string == "protein":
+                        mercat_scatter_plots(basename_ipfile, 'PI', df10, kmerstring, kmer_plots_dir)
+                        mercat_scatter_plots(basename_ipfile, 'MW', df10, kmerstring, kmer_plots_dir)
+                        mercat_scatter_plots(basename_ipfile, 'Hydro', df10, kmerstring, kmer_plots_dir)
+                    else:
+                        mercat_scatter_plots(basename_ipfile, 'GC_Percent', df10, kmerstring, kmer_plots_dir)
+                        mercat_scatter_plots(basename_ipfile, 'AT_Percent', df10, kmerstring, kmer_plots_dir)
+                mercat_stackedbar_plots(sbname,stackedbar_samples[kmer], 'Count', kmerstring, kmer_plots_dir)
+    finally:
+        report.write(report_file, inputs=all_ipfiles, k=list(kmers), alphabet=np_string, cores=num_cores,
+                     concurrent=concurrent, wall=round(timeit.default_timer() - start_time, 4))
+        print("Run report: " + report_file)
 
 
 if __name__ == "__main__":
-    mercat_main()
+    #run from the imported module, so the functions handed to the spawned sample workers and their joblib
+    #workers are mercat.mercat's rather than those of a __main__ that spawned processes do not share
+    from mercat.mercat import mercat_main as main
+    main()
@@ -1,7 +1,12 @@
 #!/usr/bin/env python
 
-import plotly.graph_objs as go
-from plotly.offline import plot
+import os
+import pickle
+import numpy as np
+from collections import OrderedDict
+
+#pandas, plotly and scikit-bio take seconds to import, they are imported
+#inside the functions that use them so the CLI starts (and fails) fast
 
 
 #predict_isoelectric_point_ProMoST code from
@@ -103,6 +108,90 @@ def predict_isoelectric_point_ProMoST(seq):
             return round(pH,2)
 
 
+#ionizable side chains counted by the ProMoST model, in the order they enter the net charge
+charged_residues = 'DECYH' + 'KR'
+
+def terminal_pk_table(column, mid_column):
+    '''256-entry pK table for a terminal residue, NaN for residues the model does not know'''
+    table = np.full(256, np.nan)
+    for c in promost_mid: table[ord(c)] = promost_mid[c][mid_column]
+    for c in promost: table[ord(c)] = promost[c][column]
+    return table
+
+nterm_pk = terminal_pk_table(2, 1)
+cterm_pk = terminal_pk_table(0, 0)
+
+
+def predict_isoelectric_point_ProMoST_batch(counts, nterm, cterm):
+    '''
+    Vectorized predict_isoelectric_point_ProMoST: runs the same bisection for
+    all k-mers at once. counts is an (n, 7) array with the number of D, E, C,
+    Y, H, K and R residues of each k-mer, nterm and cterm hold the byte codes
+    of their first and last residues. Returns pI rounded to 2 decimals, NaN
+    (with a message) for k-mers whose terminal residue is unknown.
+    '''
+    counts = np.asarray(counts, dtype=float).reshape(-1, len(charged_residues))
+    nterm = np.asarray(nterm, dtype=np.uint8)
+    cterm = np.asarray(cterm, dtype=np.uint8)
+    n = len(counts)
+
+    pKN = nterm_pk[nterm]
+    pKC = cterm_pk[cterm]
+    invalid = np.isnan(pKN) | np.isnan(pKC)
+    if invalid.any():
+        unknown = set(chr(c) for c in nterm[np.isnan(pKN)]) | set(chr(c) for c in cterm[np.isnan(pKC)])
+        print(", ".join(sorted(unknown)) + " not found! PI of " + str(int(invalid.sum())) + " k-mers set to NaN")
+
+    pK = [promost['D'][1], promost['E'][1], promost['C'][1], promost['Y'][1],
+          promost['H'][1], promost['K'][1], promost['R'][1]]
+
+    E = 0.01
+    pH = np.full(n, 6.51)
+    pHprev = np.zeros(n)
+    pHnext = np.full(n, 14.0)
+    pI = np.full(n, np.nan)
+
+    active = np.flatnonzero(~invalid)
+    while len(active):
+        ph = pH[active]
+        c = counts[active]
+        QN1 = -1.0 / (1.0 + np.power(10.0, pKN[active] - ph))
+        QP2 = 1.0 / (1.0 + np.power(10.0, ph - pKC[active]))
+        QN2 = -c[:, 0] / (1.0 + np.power(10.0, pK[0] - ph))
+        QN3 = -c[:, 1] / (1.0 + np.power(10.0, pK[1] - ph))
+        QN4 = -c[:, 2] / (1.0 + np.power(10.0, pK[2] - ph))
+        QN5 = -c[:, 3] / (1.0 + np.power(10.0, pK[3] - ph))
+        QP1 = c[:, 4] / (1.0 + np.power(10.0, ph - pK[4]))
+        QP3 = c[:, 5] / (1.0 + np.power(10.0, ph - pK[5]))
+        QP4 = c[:, 6] / (1.0 + np.power(10.0, ph - pK[6]))
+
+        NQ = QN1 + QN2 + QN3 + QN4 + QN5 + QP1 + QP2 + QP3 + QP4
+        # bisection step, same as the scalar version
+        neg = NQ < 0.0
+        prev = pHprev[active]
+        nxt = pHnext[active]
+        newph = np.where(neg, ph - ((ph - prev) / 2.0), ph + ((nxt - ph) / 2.0))
+        nxt = np.where(neg, ph, nxt)
+        prev = np.where(neg, prev, ph)
+
+        pH[active] = newph
+        pHprev[active] = prev
+        pHnext[active] = nxt
+
+        done = (newph - prev < E) & (nxt - newph < E)
+        pI[active[done]] = newph[done]
+        active = active[~done]
+
+    return np.array([round(v,2) for v in pI.tolist()])
+
+
+def predict_isoelectric_point_ProMoST_kmers(mat):
+    '''predict_isoelectric_point_ProMoST_batch for every row of a k-mer matrix'''
+    if not mat.size: return np.zeros(len(mat))
+    counts = np.stack([(mat == ord(r)).sum(axis=1) for r in charged_residues], axis=1)
+    return predict_isoelectric_point_ProMoST_batch(counts, mat[:, 0], mat[:, -1])
+
+
 mass_aa = { #monoisotopic 	average #Kyte-Doolittle?
 "A"	: 71.0788,
 "B" : 114.6686,   # Asx   Aspartic acid or Asparagine
@@ -172,11 +261,173 @@ def calculate_hydro(seq):
     return round(hydro,2)
 
 
-from skbio.diversity import alpha as skbio_alpha
-from skbio.diversity import beta as skbio_beta
+def residue_table(values):
+    '''256-entry lookup table indexed by residue byte, 0.0 for residues without a value'''
+    table = np.zeros(256)
+    for c in values: table[ord(c)] = values[c]
+    return table
+
+mass_table = residue_table(mass_aa)
+hydro_table = residue_table(hydro_scores)
+
+
+def kmer_matrix(kmers):
+    '''(n, k) uint8 matrix of the residue codes of n equal-length k-mers'''
+    kmers = np.asarray(kmers)
+    if not len(kmers): return np.zeros((0, 0), dtype=np.uint8)
+    if kmers.dtype.kind != 'S': kmers = kmers.astype('S')
+    return np.ascontiguousarray(kmers).view(np.uint8).reshape(len(kmers), kmers.dtype.itemsize)
+
+
+def sum_residue_table(mat, table):
+    '''Per-row sum of table over the residues, added left to right like the scalar functions'''
+    total = np.zeros(mat.shape[0])
+    for j in range(mat.shape[1]):
+        total += table[mat[:, j]]
+    return total
+
+
+def round2(values):
+    return [round(v,2) for v in values.tolist()]
+
+
+def calculate_MW_batch(mat):
+    '''calculate_MW for every row of a k-mer matrix'''
+    return round2(sum_residue_table(mat, mass_table) + 18.01524)
+
+
+def calculate_hydro_batch(mat):
+    '''calculate_hydro for every row of a k-mer matrix'''
+    return round2(sum_residue_table(mat, hydro_table))
+
+
+def base_percent(mat, bases):
+    '''Rounded percentage of the given bases in every row of a k-mer matrix'''
+    nbases = np.zeros(mat.shape[0], dtype=np.int64)
+    for b in bases:
+        nbases += (mat == ord(b)).sum(axis=1)
+    len_cseq = float(mat.shape[1])
+    return np.rint((nbases / len_cseq) * 100.0).astype(np.int64)
+
+
+def kmer_index(kmers):
+    import pandas as pd
+    kmers = np.asarray(kmers)
+    if kmers.dtype.kind == 'S': kmers = kmers.astype(str)
+    return pd.Index(kmers, dtype=object)
+
+
+def nucleotide_summary(kmers, counts):
+    '''Count, GC_Percent and AT_Percent table for nucleotide k-mers'''
+    mat = kmer_matrix(kmers)
+    import pandas as pd
+    return pd.DataFrame({'Count': np.asarray(counts, dtype=np.int64),
+                         'GC_Percent': base_percent(mat, "GC"),
+                         'AT_Percent': base_percent(mat, "AT")},
+                        index=kmer_index(kmers), columns=['Count', "GC_Percent", "AT_Percent"])
+
+
+class PropertyCache(object):
+    '''
+    Bounded LRU cache of protein k-mer properties. PI, MW and Hydro depend
+    only on the residue composition (plus the terminal residues for PI), so
+    entries are keyed by the sorted residues and the two terminals and are
+    computed once per composition. With a path the cache is loaded from and
+    saved to disk, so later runs with the same k reuse it.
+    '''
+
+    def __init__(self, maxsize=500000, path=None):
+        self.maxsize = maxsize
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        if path and os.path.exists(path): self.load(path)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, mat):
+        '''PI, MW and Hydro arrays for every row of a k-mer matrix'''
+        n = len(mat)
+        if not mat.size: return np.zeros(n), np.zeros(n), np.zeros(n)
+
+        k = mat.shape[1]
+        composition = np.sort(mat, axis=1)
+        keymat = np.ascontiguousarray(np.concatenate((composition, mat[:, :1], mat[:, -1:]), axis=1))
+        ukeys, inverse = np.unique(keymat.view('S%d' % (k + 2)).ravel(), return_inverse=True)
+
+        values = np.zeros((len(ukeys), 3))
+        missing = []
+        for i, key in enumerate(ukeys.tolist()):
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                values[i] = self.entries[key]
+                self.hits += 1
+            else:
+                missing.append(i)
+                self.misses += 1
+
+        if missing:
+            missing = np.array(missing)
+            keys = ukeys[missing]
+            kmat = kmer_matrix(keys)
+            comp = kmat[:, :k]
+            counts = np.stack([(comp == ord(r)).sum(axis=1) for r in charged_residues], axis=1)
+            values[missing, 0] = predict_isoelectric_point_ProMoST_batch(counts, kmat[:, k], kmat[:, k + 1])
+            values[missing, 1] = calculate_MW_batch(comp)
+            values[missing, 2] = calculate_hydro_batch(comp)
+            for i in missing.tolist():
+                self.entries[ukeys[i]] = tuple(values[i].tolist())
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+        values = values[inverse.ravel()]
+        return values[:, 0], values[:, 1], values[:, 2]
+
+    def load(self, path):
+        with open(path, 'rb') as f:
+            self.entries = OrderedDict(pickle.load(f))
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def save(self, path=None):
+        '''Write the cache, keeping entries that other runs saved to the same file in the meantime'''
+        path = path or self.path
+        if not path: return
+        entries = self.entries
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                entries = OrderedDict(pickle.load(f))
+            entries.update(self.entries)
+            while len(entries) > self.maxsize:
+                entries.popitem(last=False)
+        tmp = path + ".%d.tmp" % os.getpid()
+        with open(tmp, 'wb') as f:
+            pickle.dump(list(entries.items()), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+
+def protein_summary(kmers, counts, cache=None):
+    '''Count, PI, MW and Hydro table for protein k-mers, looked up in a PropertyCache if given'''
+    mat = kmer_matrix(kmers)
+    index = kmer_index(kmers)
+    if cache is not None:
+        pI, mw, hydro = cache.lookup(mat)
+    else:
+        pI = predict_isoelectric_point_ProMoST_kmers(mat)
+        mw = calculate_MW_batch(mat)
+        hydro = calculate_hydro_batch(mat)
+    import pandas as pd
+    return pd.DataFrame({'Count': np.asarray(counts, dtype=np.int64),
+                         'PI': pI, 'MW': mw, 'Hydro': hydro},
+                        index=index, columns=['Count', "PI", "MW", "Hydro"])
+
+
 import itertools
 
 def mercat_compute_alpha_beta_diversity(counts,bif):
+    from skbio.diversity import alpha as skbio_alpha
 
     abm = dict()
 
@@ -195,8 +446,74 @@ def mercat_compute_alpha_beta_diversity(counts,bif):
             dmptr.write(abmetric + " = " + str(abm[abmetric]) + "\n")
 
 
+def mercat_compute_alpha_diversity_histogram(values,freqs,bif):
+    '''
+    The metrics of mercat_compute_alpha_beta_diversity from a count histogram,
+    freqs[i] k-mers having count values[i], in the way scikit-bio computes them.
+    They only depend on how many k-mers have each count, so the cost is in the
+    number of distinct counts rather than of k-mers (the cohort of a k-mer store).
+    '''
+    from scipy.optimize import minimize_scalar
+
+    values = np.asarray(values, dtype=np.float64)
+    freqs = np.asarray(freqs, dtype=np.float64)
+    N = float((values * freqs).sum())
+    S = float(freqs.sum())
+    singles = float(freqs[values == 1].sum())
+    doubles = float(freqs[values == 2].sum())
+    probs = values / N
+    dominance = float((freqs * probs ** 2).sum())
+
+    abm = dict()
+    abm['shannon'] = float(-(freqs * probs * np.log(probs)).sum())
+    abm['simpson'] = 1 - dominance
+    abm['simpson_e'] = 1 / (S * dominance)
+    abm['goods_coverage'] = 1 - singles / N
+    if N == S:
+        abm['fisher_alpha'] = np.inf
+    else:
+        with np.errstate(invalid='ignore'):
+            abm['fisher_alpha'] = float(minimize_scalar(lambda x: (x * np.log(1 + N / x) - S) ** 2 if x > 0 else np.inf).x)
+    abm['dominance'] = dominance
+
+    #bias-corrected Chao1 and its confidence interval (EstimateS manual, equations 6-8, 13 and 14)
+    chao1 = S + singles * (singles - 1) / (2 * (doubles + 1))
+    abm['chao1'] = chao1
+    if singles:
+        if not doubles: var = singles * (singles - 1) / 2 + singles * (2 * singles - 1) ** 2 / 4 - singles ** 4 / (4 * chao1)
+        else: var = (singles * (singles - 1) / (2 * (doubles + 1)) + singles * (2 * singles - 1) ** 2 / (4 * (doubles + 1) ** 2) +
+                     singles ** 2 * doubles * (singles - 1) ** 2 / (4 * (doubles + 1) ** 4))
+        T = chao1 - S
+        if T == 0: abm['chao1_ci'] = (S, S)
+        else:
+            K = float(np.exp(1.96 * np.sqrt(np.log(1 + var / T ** 2))))
+            abm['chao1_ci'] = (S + T / K, S + T * K)
+    else:
+        P = float(np.exp(-N / S))
+        abm['chao1_ci'] = (max(S, S / (1 - P) - 1.96 * np.sqrt(S * P / (1 - P))), S / (1 - P) + 1.96 * float(np.sqrt(S * P / (1 - P))))
+
+    #ACE with k-mers of count <= 10 as the rare ones
+    rare = values <= 10
+    s_rare = float(freqs[rare].sum())
+    if singles > 0 and singles == s_rare:
+        abm['ace'] = np.nan #undefined when all rare k-mers are singletons
+    elif s_rare == 0:
+        abm['ace'] = S
+    else:
+        n_rare = float((values[rare] * freqs[rare]).sum())
+        c_ace = 1 - singles / n_rare
+        gamma_ace = max(s_rare * float((values[rare] * (values[rare] - 1) * freqs[rare]).sum()) / (c_ace * n_rare * (n_rare - 1)) - 1, 0)
+        abm['ace'] = (S - s_rare) + s_rare / c_ace + singles / c_ace * gamma_ace
+
+    with open(bif + "_diversity_metrics.txt", 'w') as dmptr:
+        for abmetric in abm:
+            dmptr.write(abmetric + " = " + str(abm[abmetric]) + "\n")
+
+
 
-def mercat_scatter_plots(bif,xlab,res_df,kmerstring):
+def mercat_scatter_plots(bif,xlab,res_df,kmerstring,out_dir="."):
+    import plotly.graph_objs as go
+    from plotly.offline import plot
 
     axis_title_font_size = 20
     axis_tick_label_size = 18
@@ -211,7 +528,7 @@ def mercat_scatter_plots(bif,xlab,res_df,kmerstring):
         mode='markers'
     )
 
-    data = go.Data([trace1])
+    data = [trace1]
     layout = go.Layout(
         legend=dict(
             font=dict(
@@ -236,7 +553,7 @@ def mercat_scatter_plots(bif,xlab,res_df,kmerstring):
             tickwidth=2,
             tickcolor='#000',
             #tickvals=list(reversed(cores)),
-            titlefont=dict(
+            title_font=dict(
                 # family='Courier New, monospace',
                 size=axis_title_font_size,
                 color='black'
@@ -262,7 +579,7 @@ def mercat_scatter_plots(bif,xlab,res_df,kmerstring):
             ticklen=8,
             tickwidth=2,
             tickcolor='#000',
-            titlefont=dict(
+            title_font=dict(
                 # family='Courier New, monospace',
                 size=axis_title_font_size,
                 color='black'
@@ -288,11 +605,13 @@ def mercat_scatter_plots(bif,xlab,res_df,kmerstring):
     )
 
     fig = go.Figure(data=data, layout=layout)
-    plot(fig, filename=bif + "_"+xlab+".html", auto_open=False)
+    plot(fig, filename=os.path.join(out_dir, bif + "_"+xlab+".html"), auto_open=False)
 
 
 
-def mercat_stackedbar_plots(inp_folder,top10_all_samples,xlab,kmerstring):
+def mercat_stackedbar_plots(inp_folder,top10_all_samples,xlab,kmerstring,out_dir="."):
+    import plotly.graph_objs as go
+    from plotly.offline import plot
     axis_title_font_size = 20
     axis_tick_label_size = 18
     legend_font_size = 14
@@ -354,7 +673,7 @@ def mercat_stackedbar_plots(inp_folder,top10_all_samples,xlab,kmerstring):
         all_annotations.append(annotations)
 
 
-    data = go.Data(btraces)
+    data = btraces
     layout = go.Layout(
         barmode='stack',
         annotations=list(itertools.chain.from_iterable(all_annotations)),
@@ -381,7 +700,7 @@ def mercat_stackedbar_plots(inp_folder,top10_all_samples,xlab,kmerstring):
             tickwidth=2,
             tickcolor='#000',
             #tickvals=list(reversed(cores)),
-            titlefont=dict(
+            title_font=dict(
                 # family='Courier New, monospace',
                 size=axis_title_font_size,
                 color='black'
@@ -407,7 +726,7 @@ def mercat_stackedbar_plots(inp_folder,top10_all_samples,xlab,kmerstring):
             ticklen=8,
             tickwidth=2,
             tickcolor='#000',
-            titlefont=dict(
+            title_font=dict(
                 # family='Courier New, monospace',
                 size=axis_title_font_size,
                 color='black'
@@ -433,4 +752,4 @@ def mercat_stackedbar_plots(inp_folder,top10_all_samples,xlab,kmerstring):
     )
 
     fig = go.Figure(data=data, layout=layout)
-    plot(fig, filename=inp_folder + "_barchart_"+xlab+".html", auto_open=False)
+    plot(fig, filename=os.path.join(out_dir, inp_folder + "_barchart_"+xlab+".html"), auto_open=False)
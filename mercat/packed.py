@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+"""packed.py: 2-bit packed k-mer encoding and NumPy counting for nucleotide input."""
+
+import numpy as np
+
+
+max_packed_kmer = 32 #2 bits per base in a uint64
+bincount_max_kmer = 10 #use a dense bincount up to 4^10 bins, sort/unique beyond
+
+nucleotides = b'ACGT'
+AMBIGUOUS = 4
+
+#byte -> 2-bit code, anything other than ACGT (N, IUPAC codes, '*') is ambiguous
+base_codes = np.full(256, AMBIGUOUS, dtype=np.uint8)
+for code, base in enumerate(nucleotides):
+    base_codes[base] = code
+    base_codes[ord(chr(base).lower())] = code
+
+
+def encode_sequence(cseq):
+    '''Map a nucleotide string to an array of 2-bit codes, ambiguous bases become AMBIGUOUS'''
+    return base_codes[np.frombuffer(cseq.encode('ascii', 'replace'), dtype=np.uint8)]
+
+
+def encode_sequences(seqs):
+    '''Encode a batch of sequences as one array, separated so that no window spans two sequences'''
+    return encode_sequence('N'.join(seqs))
+
+
+def kmer_codes(codes, kmer):
+    '''Pack all k-mer windows of an encoded sequence into uint64, skipping windows with ambiguous bases'''
+    nwin = len(codes) - kmer + 1
+    if nwin <= 0: return np.empty(0, dtype=np.uint64)
+
+    nambiguous = np.concatenate(([0], np.cumsum(codes == AMBIGUOUS)))
+    valid = nambiguous[kmer:] == nambiguous[:nwin]
+
+    codes64 = (codes & 3).astype(np.uint64)
+    packed = np.zeros(nwin, dtype=np.uint64)
+    two = np.uint64(2)
+    for i in range(kmer):
+        packed <<= two
+        packed |= codes64[i:i + nwin]
+
+    return packed[valid]
+
+
+def count_kmer_codes(packed, kmer):
+    '''Count packed k-mers, returns (sorted unique codes, counts)'''
+    if kmer <= bincount_max_kmer:
+        bins = np.bincount(packed.astype(np.intp), minlength=4**kmer)
+        codes = np.flatnonzero(bins)
+        return codes.astype(np.uint64), bins[codes].astype(np.int64)
+
+    codes, counts = np.unique(packed, return_counts=True)
+    return codes, counts.astype(np.int64)
+
+
+def calculateKmerCount_packed(cseq,kmer):
+    '''Count the k-mers of one nucleotide sequence as 2-bit packed codes'''
+    return count_kmer_codes(kmer_codes(encode_sequence(cseq), kmer), kmer)
+
+
+def merge_kmer_codes(tables):
+    '''Sum a list of (codes, counts) tables into one table sorted by code'''
+    tables = list(tables)
+    if not tables:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64)
+    if len(tables) == 1: return tables[0]
+
+    codes = np.concatenate([t[0] for t in tables])
+    counts = np.concatenate([t[1] for t in tables])
+    if not len(codes): return codes, counts
+
+    order = np.argsort(codes, kind='stable')
+    codes = codes[order]
+    starts = np.flatnonzero(np.concatenate(([True], codes[1:] != codes[:-1])))
+    return codes[starts], np.add.reduceat(counts[order], starts)
+
+
+def pack_kmers(kmers, kmer):
+    '''Pack an array of k-mer byte strings into uint64 codes, None if any k-mer has an ambiguous base'''
+    kmers = np.ascontiguousarray(np.asarray(kmers, dtype='S%d' % kmer))
+    codes = base_codes[kmers.view(np.uint8).reshape(len(kmers), kmer)]
+    if (codes == AMBIGUOUS).any(): return None
+    packed = np.zeros(len(kmers), dtype=np.uint64)
+    for i in range(kmer):
+        packed <<= np.uint64(2)
+        packed |= codes[:, i].astype(np.uint64)
+    return packed
+
+
+def decode_kmer_bytes(codes, kmer):
+    '''Turn packed codes back into an array of k-mer byte strings'''
+    if not len(codes): return np.empty(0, dtype='S%d' % kmer)
+    shifts = np.arange(2 * (kmer - 1), -1, -2, dtype=np.uint64)
+    digits = (codes[:, None] >> shifts[None, :]) & np.uint64(3)
+    letters = np.frombuffer(nucleotides, dtype=np.uint8)[digits.astype(np.intp)]
+    return np.ascontiguousarray(letters).view('S%d' % kmer).ravel()
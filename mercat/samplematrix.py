@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+"""samplematrix.py: Sparse sample x k-mer count matrix of a folder run and the beta diversity between samples."""
+
+import json
+import numpy as np
+
+from .packed import decode_kmer_bytes
+
+
+#pairs of samples that share a k-mer, handled per numpy call while summing the distances
+pair_block_size = 1 << 22
+
+
+def save_kmer_vector(prefix, keys, counts):
+    '''Save the k-mers (packed codes or bytes) and counts of one sample, sorted by k-mer'''
+    order = np.argsort(keys, kind='stable')
+    np.save(prefix + ".keys.npy", keys[order])
+    np.save(prefix + ".counts.npy", np.asarray(counts, dtype=np.int64)[order])
+    return prefix
+
+
+def load_kmer_vector(prefix, kmer, as_bytes=False):
+    '''(keys, counts) of a saved sample; as_bytes turns packed codes into k-mer bytes, which sort the same way'''
+    keys = np.load(prefix + ".keys.npy")
+    if as_bytes and keys.dtype == np.uint64: keys = decode_kmer_bytes(keys, kmer)
+    return keys, np.load(prefix + ".counts.npy")
+
+
+def vector_key_type(prefixes):
+    '''True when every sample has packed codes, otherwise all are compared as k-mer bytes'''
+    return all(np.load(p + ".keys.npy", mmap_mode='r').dtype == np.uint64 for p in prefixes)
+
+
+def unique_keys(prefixes, kmer, as_bytes):
+    return np.unique(np.concatenate([load_kmer_vector(p, kmer, as_bytes)[0] for p in prefixes]))
+
+
+def kmer_vocabulary(prefixes, kmer, as_bytes, num_cores, parallel):
+    '''Sorted union of the k-mers of all samples: groups of samples are merged
+    in parallel, then the group unions are merged pairwise, a level at a time'''
+    from joblib import delayed
+    ngroups = max(1, min(len(prefixes), 4 * num_cores))
+    parts = parallel(delayed(unique_keys)(prefixes[g::ngroups], kmer, as_bytes) for g in range(ngroups))
+    while len(parts) > 1:
+        merged = parallel(delayed(np.union1d)(a, b) for a, b in zip(parts[0::2], parts[1::2]))
+        if len(parts) % 2: merged.append(parts[-1])
+        parts = merged
+    return parts[0]
+
+
+def sample_columns(prefix, vocabulary, kmer, as_bytes):
+    keys, counts = load_kmer_vector(prefix, kmer, as_bytes)
+    return np.searchsorted(vocabulary, keys), counts
+
+
+def build_sample_matrix(prefixes, kmer, num_cores, parallel):
+    '''
+    CSR matrix with one row per sample (in the order of prefixes) and one column
+    per k-mer of the vocabulary, returned with the vocabulary. Only the
+    vocabulary and the matrix itself are ever held in memory, the rows are
+    filled a round of samples at a time.
+    '''
+    from joblib import delayed
+    from scipy import sparse
+    as_bytes = not vector_key_type(prefixes)
+    vocabulary = kmer_vocabulary(prefixes, kmer, as_bytes, num_cores, parallel)
+
+    sizes = [len(np.load(p + ".keys.npy", mmap_mode='r')) for p in prefixes]
+    indptr = np.zeros(len(prefixes) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(sizes)
+    index_dtype = np.int32 if max(len(vocabulary), indptr[-1]) < np.iinfo(np.int32).max else np.int64
+    indices = np.empty(indptr[-1], dtype=index_dtype)
+    data = np.empty(indptr[-1], dtype=np.int64)
+
+    for first in range(0, len(prefixes), num_cores):
+        rows = range(first, min(first + num_cores, len(prefixes)))
+        results = parallel(delayed(sample_columns)(prefixes[i], vocabulary, kmer, as_bytes) for i in rows)
+        for i, (columns, counts) in zip(rows, results):
+            indices[indptr[i]:indptr[i + 1]] = columns
+            data[indptr[i]:indptr[i + 1]] = counts
+
+    matrix = sparse.csr_matrix((data, indices, indptr.astype(index_dtype)), shape=(len(prefixes), len(vocabulary)))
+    return matrix, vocabulary
+
+
+def save_sample_matrix(path_base, matrix, vocabulary, sample_names, metadata):
+    '''
+    Write the matrix as path_base + "_matrix.npz" (scipy.sparse.save_npz) and its
+    row and column labels as path_base + "_matrix_labels.npz": sample names,
+    k-mers as packed codes or bytes like the npz count tables, and the metadata.
+    '''
+    from scipy import sparse
+    sparse.save_npz(path_base + "_matrix.npz", matrix, compressed=False)
+    labels = {'samples': np.array(sample_names), 'metadata': np.array(json.dumps(metadata))}
+    if vocabulary.dtype == np.uint64: labels['codes'] = vocabulary
+    else: labels['kmers'] = vocabulary
+    np.savez(path_base + "_matrix_labels.npz", **labels)
+    return path_base + "_matrix.npz"
+
+
+def read_sample_matrix(path_base):
+    '''(CSR matrix, sample names, k-mer byte strings, metadata) written by save_sample_matrix'''
+    from scipy import sparse
+    matrix = sparse.load_npz(path_base + "_matrix.npz")
+    with np.load(path_base + "_matrix_labels.npz") as labels:
+        metadata = json.loads(str(labels['metadata']))
+        if 'codes' in labels: kmers = decode_kmer_bytes(labels['codes'], metadata['k'])
+        else: kmers = labels['kmers']
+        samples = labels['samples'].astype(str).tolist()
+    return matrix, samples, kmers, metadata
+
+
+def shared_kmer_sums(indptr, rows, values, nsamples):
+    '''
+    For a block of CSC columns (k-mers), the sum of min(count_i, count_j) and
+    the number of shared k-mers for every pair of samples i, j. Columns are
+    grouped by their number of samples so that each group is one vectorized
+    pass over all its pairs; within a column the entries are sorted by count,
+    so the first of every pair holds the minimum. Each pair is counted once,
+    as (i, j) or (j, i).
+    '''
+    minsum = np.zeros(nsamples * nsamples)
+    shared = np.zeros(nsamples * nsamples, dtype=np.int64)
+    sizes = np.diff(indptr)
+    for size in np.unique(sizes[sizes >= 2]):
+        cols = np.flatnonzero(sizes == size)
+        first, second = np.triu_indices(size, 1)
+        step = max(1, pair_block_size // len(first))
+        for start in range(0, len(cols), step):
+            pos = indptr[cols[start:start + step]][:, None] + np.arange(size)
+            order = np.argsort(values[pos], axis=1, kind='stable')
+            pos = np.take_along_axis(pos, order, axis=1)
+            pairs = (rows[pos[:, first]].astype(np.int64) * nsamples + rows[pos[:, second]]).ravel()
+            minsum += np.bincount(pairs, weights=values[pos[:, first]].ravel(), minlength=nsamples * nsamples)
+            shared += np.bincount(pairs, minlength=nsamples * nsamples)
+    return minsum.reshape(nsamples, nsamples), shared.reshape(nsamples, nsamples)
+
+
+def column_blocks(csc, nblocks):
+    '''Column ranges of csc with about the same number of sample pairs each'''
+    sizes = np.diff(csc.indptr).astype(np.int64)
+    work = np.cumsum(sizes * (sizes - 1) // 2)
+    if not len(work) or not work[-1]: return [(0, csc.shape[1])]
+    bounds = np.searchsorted(work, np.linspace(0, work[-1], nblocks + 1)[1:-1])
+    bounds = np.unique(np.concatenate([[0], bounds, [csc.shape[1]]]))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def beta_diversity(matrix, num_cores, parallel):
+    '''
+    Bray-Curtis (on counts) and Jaccard (on presence) distance matrices between
+    the rows of a sample x k-mer matrix. Only the k-mers two samples share
+    contribute to a pair, so the work is split over blocks of k-mer columns,
+    summed in parallel and combined with the per-sample totals.
+    '''
+    from joblib import delayed
+    nsamples = matrix.shape[0]
+    csc = matrix.tocsc()
+    csc.sort_indices()
+    minsum = np.zeros((nsamples, nsamples))
+    shared = np.zeros((nsamples, nsamples), dtype=np.int64)
+    blocks = column_blocks(csc, 4 * num_cores)
+    for first in range(0, len(blocks), num_cores):
+        tasks = []
+        for start, end in blocks[first:first + num_cores]:
+            a, b = csc.indptr[start], csc.indptr[end]
+            tasks.append(delayed(shared_kmer_sums)(csc.indptr[start:end + 1] - a, csc.indices[a:b],
+                                                   csc.data[a:b], nsamples))
+        for block_minsum, block_shared in parallel(tasks):
+            minsum += block_minsum
+            shared += block_shared
+    del csc
+
+    minsum += minsum.T
+    shared += shared.T
+    totals = np.asarray(matrix.sum(axis=1), dtype=np.float64).ravel()
+    nkmers = np.diff(matrix.indptr).astype(np.float64)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        denominator = totals[:, None] + totals[None, :]
+        braycurtis = np.where(denominator > 0, 1.0 - 2.0 * minsum / denominator, 0.0)
+        union = nkmers[:, None] + nkmers[None, :] - shared
+        jaccard = np.where(union > 0, 1.0 - shared / union, 0.0)
+    np.fill_diagonal(braycurtis, 0.0)
+    np.fill_diagonal(jaccard, 0.0)
+    return braycurtis, jaccard
+
+
+def write_distance_matrix(fn, distances, sample_names):
+    '''Tab separated square matrix with sample names as header and first column'''
+    import pandas as pd
+    pd.DataFrame(distances, index=sample_names, columns=sample_names).to_csv(fn, sep='\t', float_format='%.6f')
+    return fn
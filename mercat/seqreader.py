@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+"""seqreader.py: Streaming FASTA/FASTQ record readers for plain and compressed files."""
+
+import os
+import sys
+import bz2
+import gzip
+import lzma
+import zlib
+
+
+#compressed inputs are recognised by extension, .bgz is BGZF (blocked gzip)
+compression_ext = {'.gz': 'gzip', '.bgz': 'gzip', '.bz2': 'bz2', '.xz': 'xz'}
+compression_openers = {'gzip': gzip.open, 'bz2': bz2.open, 'xz': lzma.open}
+
+
+def compression_of(path):
+    '''Compression of a file by extension: gzip, bz2, xz or None for plain files'''
+    return compression_ext.get(os.path.splitext(path)[1].lower())
+
+
+def strip_compression_ext(path):
+    '''Path without a trailing compression extension: test.fq.gz -> test.fq'''
+    if compression_of(path): return os.path.splitext(path)[0]
+    return path
+
+
+def open_text(path):
+    '''Open a plain or compressed file for reading text'''
+    compression = compression_of(path)
+    if compression: return compression_openers[compression](path, 'rt')
+    return open(path, 'r')
+
+
+def is_fastq_file(path):
+    '''Sniff the first record marker: True for FASTQ (@), False for FASTA (>)'''
+    with open_text(path) as f:
+        for line in f:
+            if line.startswith(">"): return False
+            elif line.startswith("@"): return True
+    return False
+
+
+def read_fasta(f):
+    '''Yield (name, sequence) for each record of an open FASTA file'''
+    sname = None
+    seq = []
+    for line in f:
+        line = line.strip()
+        if line.startswith(">"):
+            if sname is not None or seq:
+                yield sname or "", "".join(seq)
+            sname = line[1:].split("#",1)[0].strip()
+            seq = []
+        else:
+            seq.append(line.replace("*",""))
+
+    if sname is not None or seq:
+        yield sname or "", "".join(seq)
+
+
+def read_fastq(f):
+    '''Yield (name, sequence) for each 4-line record of an open FASTQ file'''
+    for header in f:
+        header = header.strip()
+        if not header: continue
+        cseq = next(f, "").strip()
+        next(f, None) # + line
+        next(f, None) # quality line
+        sname = header[1:].split()
+        yield (sname[0] if sname else ""), cseq
+
+
+def gzip_range_chunks(path, start, end, bufsize=1 << 20):
+    '''
+    Yield the decompressed bytes of a multi-member gzip (or BGZF) file
+    between two virtual offsets. A virtual offset is a (member offset,
+    offset inside the decompressed member) pair, as produced by
+    mercat_gzip_partitioner; end may be None for the end of the file.
+    '''
+    if end is None: end = (os.path.getsize(path), 0)
+    with open(path, 'rb') as f:
+        f.seek(start[0])
+        fed = start[0] #compressed offset just past the data fed to the decompressor
+        skip = start[1] #decompressed bytes still to drop from the first member
+        limit = end[1] - start[1] if start[0] >= end[0] else None #decompressed bytes still wanted from the last member
+        d = zlib.decompressobj(31)
+        buf = b''
+        while limit != 0:
+            if not buf:
+                buf = f.read(bufsize)
+                if not buf: break
+                fed += len(buf)
+            out = d.decompress(buf)
+            buf = b''
+            if skip:
+                dropped = min(skip, len(out))
+                out = out[dropped:]
+                skip -= dropped
+            if limit is not None:
+                out = out[:limit]
+                limit -= len(out)
+            if out: yield out
+
+            if d.eof:
+                if limit is not None: break
+                #the next member starts right after this one
+                buf = d.unused_data
+                if fed - len(buf) >= end[0]: limit = end[1]
+                d = zlib.decompressobj(31)
+
+
+def read_chunks(path, start=0, end=None, bufsize=1 << 20):
+    '''Yield the (decompressed) bytes of a file or of a range of it. Ranges of
+    plain files are byte offsets, ranges of gzip files are virtual offsets.'''
+    compression = compression_of(path)
+    if isinstance(start, tuple):
+        for chunk in gzip_range_chunks(path, start, end, bufsize):
+            yield chunk
+        return
+
+    if compression:
+        with compression_openers[compression](path, 'rb') as f:
+            while True:
+                buf = f.read(bufsize)
+                if not buf: break
+                yield buf
+        return
+
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = None if end is None else end - start
+        while remaining is None or remaining > 0:
+            buf = f.read(bufsize if remaining is None else min(remaining, bufsize))
+            if not buf: break
+            if remaining is not None: remaining -= len(buf)
+            yield buf
+
+
+def read_lines(path, start=0, end=None):
+    '''Yield the text lines of a file, or of a record-aligned range of it'''
+    tail = b''
+    for chunk in read_chunks(path, start, end):
+        lines = (tail + chunk).split(b'\n')
+        tail = lines.pop()
+        for line in lines:
+            yield line.decode('utf-8', 'replace') + '\n'
+    if tail: yield tail.decode('utf-8', 'replace')
+
+
+def read_records(path, is_fastq=None, start=0, end=None):
+    '''Stream (name, sequence) records from a plain or compressed FASTA or FASTQ
+    file, or from a range of it that starts on a record boundary'''
+    if is_fastq is None: is_fastq = is_fastq_file(path)
+    if start or end is not None:
+        lines = read_lines(path, start, end)
+        reader = read_fastq(lines) if is_fastq else read_fasta(lines)
+        for record in reader:
+            yield record
+        return
+
+    with open_text(path) as f:
+        reader = read_fastq(f) if is_fastq else read_fasta(f)
+        for record in reader:
+            yield record
+
+
+def write_fasta(records, f):
+    '''Write (name, sequence) records to an open file as FASTA, returns the number written'''
+    nrecords = 0
+    for sname, cseq in records:
+        f.write(">" + sname + "\n" + cseq + "\n")
+        nrecords += 1
+    return nrecords
+
+
+def fastq_to_fasta(fin, fout):
+    '''Convert FASTQ read from an open file to FASTA on another, one record at a time
+    so that any size of input runs in constant memory. Returns the number of records'''
+    return write_fasta(read_fastq(fin), fout)
+
+
+if __name__ == '__main__':
+    #FASTQ -> FASTA filter for tool pipelines: python -m mercat.seqreader < reads.fq > reads.fa
+    try:
+        fastq_to_fasta(sys.stdin, sys.stdout)
+        sys.stdout.flush()
+    except BrokenPipeError:
+        #the next tool exited early: fail quietly, so only that tool's error ends up in the log
+        #(stdout goes to devnull so that flushing it at exit cannot raise again)
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
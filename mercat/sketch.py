@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+"""sketch.py: Count-Min sketch prefilter that drops k-mers which cannot reach the minimum count."""
+
+import numpy as np
+from collections import Counter
+
+from .packed import merge_kmer_codes
+from .spill import hash_keys, table_arrays
+
+
+min_sketch_width = 1 << 10
+sketch_depth = 4
+
+def sketch_width(nbases, kmer, alphabet_size, memory_budget, depth=sketch_depth):
+    '''Power of two width with about one cell per distinct k-mer, using at most a quarter of memory_budget'''
+    distinct = min(float(alphabet_size) ** kmer, float(nbases))
+    width = min_sketch_width
+    while width < distinct and 2 * width * depth * 4 <= memory_budget // 4:
+        width *= 2
+    return width
+
+
+class CountMinSketch(object):
+    '''
+    Count-Min sketch of k-mer counts, built in a first pass over the input.
+    Counts are saturated at min_count, which is all the filter needs to know.
+    A Count-Min estimate never undercounts, so every k-mer whose true count
+    reaches min_count is admitted in the second pass; the few sub-threshold
+    k-mers that collide their way in are removed by the exact -c filter.
+
+    Workers only compute the cells a partial table touches (cells); the
+    main process folds them into the sketch (add). After save() the sketch
+    lives in a .npy file which the workers memory-map to filter (admit).
+    '''
+
+    def __init__(self, width, depth, min_count):
+        self.width = width
+        self.depth = depth
+        self.min_count = min_count
+        self.dtype = np.uint16 if min_count < np.iinfo(np.uint16).max else np.uint32
+        self.table = np.zeros((depth, width), dtype=self.dtype)
+        self.path = None
+
+    @property
+    def building(self):
+        return self.path is None
+
+    def __getstate__(self):
+        #workers never get a copy of the table, they map the saved file
+        state = self.__dict__.copy()
+        state['table'] = None
+        return state
+
+    def cell_indices(self, keys):
+        '''(depth, len(keys)) column of every key in each row, by double hashing'''
+        h = hash_keys(keys)
+        h1 = h & np.uint64(0xffffffff)
+        h2 = (h >> np.uint64(32)) | np.uint64(1)
+        rows = np.arange(self.depth, dtype=np.uint64)[:, None]
+        return ((h1[None, :] + rows * h2[None, :]) & np.uint64(self.width - 1)).astype(np.intp)
+
+    def cells(self, table, backend, kmer):
+        '''Sketch cells touched by a partial count table, as a packed (cell ids, counts) table'''
+        keys, counts = table_arrays(table, backend, kmer)
+        if not len(keys): return merge_kmer_codes([])
+        cols = self.cell_indices(keys)
+        ids = (cols + (np.arange(self.depth) * self.width)[:, None]).astype(np.uint64)
+        counts = np.minimum(counts, self.min_count)
+        ids, counts = merge_kmer_codes([(row, counts) for row in ids])
+        return ids, np.minimum(counts, self.min_count)
+
+    def add(self, cells):
+        '''Fold a (cell ids, counts) table into the sketch'''
+        ids, counts = cells
+        flat = self.table.reshape(-1)
+        ids = ids.astype(np.intp)
+        flat[ids] = np.minimum(flat[ids] + counts, self.min_count).astype(self.dtype)
+
+    def save(self, path):
+        np.save(path, self.table)
+        self.path = path
+
+    def load(self, path):
+        '''Use a sketch saved before (e.g. by an interrupted run) instead of building one'''
+        self.table = np.load(path, mmap_mode='r')
+        self.path = path
+
+    def estimate(self, keys):
+        '''Count-Min estimate (saturated at min_count) of every key'''
+        if self.table is None: self.table = np.load(self.path, mmap_mode='r')
+        cols = self.cell_indices(keys)
+        return self.table[np.arange(self.depth)[:, None], cols].min(axis=0)
+
+    def admit(self, table, backend, kmer):
+        '''The part of a partial count table whose k-mers may reach min_count'''
+        keys, counts = table_arrays(table, backend, kmer)
+        keep = self.estimate(keys) >= self.min_count if len(keys) else np.zeros(0, dtype=bool)
+        if backend == 'numpy': return keys[keep], counts[keep]
+        return Counter(dict((k, v) for (k, v), admitted in zip(table.items(), keep) if admitted))
+
+    def fill_ratio(self):
+        '''Fraction of saturated cells in the first row, a rough measure of how selective the filter is'''
+        if self.table is None: self.table = np.load(self.path, mmap_mode='r')
+        return float(np.count_nonzero(self.table[0] >= self.min_count)) / self.width
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+"""spill.py: External-memory k-mer counting through hash-partitioned bucket files."""
+
+import os
+import glob
+import uuid
+import shutil
+import numpy as np
+
+from .packed import merge_kmer_codes
+
+
+#bytes one distinct k-mer takes while counting: packed (code, count) arrays plus
+#sort buffers, or a python str key and int value in a dict
+packed_entry_bytes = 48
+dict_entry_bytes = 120
+
+def estimate_table_bytes(nbases, kmer, alphabet_size, backend):
+    '''Upper estimate of the memory a count table over nbases bases needs'''
+    distinct = min(float(alphabet_size) ** kmer, float(nbases))
+    per_entry = packed_entry_bytes if backend == 'numpy' else dict_entry_bytes + kmer
+    return int(distinct * per_entry)
+
+
+def table_arrays(table, backend, kmer):
+    '''(keys, counts) arrays of a count table: packed codes for numpy, k-mer bytes otherwise'''
+    if backend == 'numpy': return table
+    keys = np.array(list(table.keys()), dtype='S%d' % kmer)
+    counts = np.fromiter(table.values(), dtype=np.int64, count=len(table))
+    return keys, counts
+
+
+def hash_keys(keys):
+    '''64-bit hashes of packed codes or k-mer bytes, identical in every process (unlike hash())'''
+    if keys.dtype == np.uint64:
+        return keys * np.uint64(0x9E3779B97F4A7C15)
+    #FNV-1a over the k-mer bytes
+    mat = np.ascontiguousarray(keys).view(np.uint8).reshape(len(keys), keys.dtype.itemsize)
+    h = np.full(len(keys), 14695981039346656037, dtype=np.uint64)
+    prime = np.uint64(1099511628211)
+    for j in range(mat.shape[1]):
+        h ^= mat[:, j].astype(np.uint64)
+        h *= prime
+    return h
+
+
+def bucket_ids(keys, nbuckets):
+    '''Stable hash partition of k-mer keys into nbuckets buckets'''
+    return ((hash_keys(keys) >> np.uint64(29)) % np.uint64(nbuckets)).astype(np.intp)
+
+
+class KmerSpill(object):
+    '''
+    Disk-backed k-mer counting. Every worker task writes its partial table
+    once, sorted by bucket, as keys/counts/offsets .npy files. Each bucket
+    is then counted on its own by reading its slice of every part, so only
+    one bucket per worker has to fit in memory. The bucket offsets of all parts,
+    and where their keys and counts start in the .npy files, are read once
+    (load_offsets) and handed to the workers with the spill.
+    '''
+
+    def __init__(self, directory, nbuckets, backend, kmer):
+        self.directory = directory
+        self.nbuckets = nbuckets
+        self.backend = backend
+        self.kmer = kmer
+        self.part_names = None
+        self.part_offsets = None
+        self.part_arrays = None
+        if not os.path.exists(directory): os.makedirs(directory)
+
+    def write(self, table):
+        '''Spill one partial count table'''
+        keys, counts = table_arrays(table, self.backend, self.kmer)
+        if not len(keys): return
+        buckets = bucket_ids(keys, self.nbuckets)
+        order = np.argsort(buckets, kind='stable')
+        offsets = np.searchsorted(buckets[order], np.arange(self.nbuckets + 1))
+
+        part = os.path.join(self.directory, "part-" + uuid.uuid4().hex)
+        np.save(part + ".keys.npy", keys[order])
+        np.save(part + ".counts.npy", counts[order])
+        #the offsets file is written last and marks the part as complete
+        np.save(part + ".offsets.npy", offsets)
+        self.part_offsets = None
+
+    def chunk(self, name):
+        '''An empty spill with the same buckets in the subfolder name, whose parts count
+        as parts of this spill (used for checkpointing a chunk's parts on their own)'''
+        directory = os.path.join(self.directory, name)
+        if os.path.exists(directory): shutil.rmtree(directory)
+        return KmerSpill(directory, self.nbuckets, self.backend, self.kmer)
+
+    def parts(self):
+        offsets = (glob.glob(os.path.join(self.directory, "part-*.offsets.npy")) +
+                   glob.glob(os.path.join(self.directory, "*", "part-*.offsets.npy")))
+        return sorted(fn[:-len(".offsets.npy")] for fn in offsets)
+
+    def load_offsets(self):
+        '''Read the bucket offsets of every part (one row per part), and the file offset
+        and dtype of its keys and counts arrays'''
+        self.part_names = self.parts()
+        self.part_offsets = np.zeros((len(self.part_names), self.nbuckets + 1), dtype=np.int64)
+        self.part_arrays = []
+        for i, part in enumerate(self.part_names):
+            self.part_offsets[i] = np.load(part + ".offsets.npy")
+            keys = np.load(part + ".keys.npy", mmap_mode='r')
+            counts = np.load(part + ".counts.npy", mmap_mode='r')
+            self.part_arrays.append((keys.offset, keys.dtype, counts.offset, counts.dtype))
+            del keys, counts
+
+    def count_bucket(self, bucket, prune_kmer):
+        '''Merge one bucket over all parts. Returns the keys and counts with
+        count >= prune_kmer, and the number of distinct k-mers in the bucket.'''
+        if self.part_offsets is None: self.load_offsets()
+        keys = []
+        counts = []
+        #only the parts that have k-mers in the bucket are opened
+        starts, ends = self.part_offsets[:, bucket], self.part_offsets[:, bucket + 1]
+        for i in np.flatnonzero(ends > starts):
+            part, start, n = self.part_names[i], int(starts[i]), int(ends[i] - starts[i])
+            #the slices are read at their offset in the .npy files, whose headers were parsed once
+            koffset, kdtype, coffset, cdtype = self.part_arrays[i]
+            keys.append(np.fromfile(part + ".keys.npy", dtype=kdtype, count=n, offset=koffset + start * kdtype.itemsize))
+            counts.append(np.fromfile(part + ".counts.npy", dtype=cdtype, count=n, offset=coffset + start * cdtype.itemsize))
+
+        keys, counts = merge_kmer_codes(list(zip(keys, counts)))
+        significant = counts >= prune_kmer
+        return keys[significant], counts[significant], len(keys)
+
+    def remove(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def spill_buckets(table_bytes, memory_budget, num_cores):
+    '''Number of buckets so that num_cores buckets at a time fit in memory_budget'''
+    per_bucket = max(memory_budget // max(num_cores, 1), 1)
+    return int(max(num_cores, -(-table_bytes // per_bucket)))
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+"""store.py: Append-able on-disk k-mer count store of a growing cohort of samples, one per k and alphabet."""
+
+import os
+import json
+import fcntl
+import shutil
+import numpy as np
+from collections import Counter
+from contextlib import contextmanager
+
+from .packed import decode_kmer_bytes
+
+
+#delta segments are merged into one once there are more than this many,
+#and into the main segment once they hold a quarter as many k-mers as it does
+max_delta_segments = 8
+delta_fraction = 4
+
+
+def store_name(kmer, alphabet):
+    return alphabet + "_" + str(kmer) + "-mers"
+
+
+class KmerStore(object):
+    '''
+    Cohort k-mer counts for one k and alphabet, in a folder that samples are
+    added to one at a time. Every sample's summary counts (count >= min_count)
+    are kept under samples/, with its top 10 for the stacked bar chart.
+    The cohort totals are sorted segments of (k-mer bytes, count) .npy files
+    with disjoint k-mers: adding a sample updates the counts of k-mers already
+    in a segment in place (memory-mapped) and writes its new k-mers as a new
+    delta segment; deltas are merged now and then, so the cost of an add is
+    about the size of the sample, not of the cohort. The count histogram
+    (for diversity) and the top k-mers are updated from the touched k-mers
+    alone, counts only grow so the new top is among the old top and them.
+    While an add is in progress the store is marked dirty; a store found
+    dirty (an interrupted add) is rebuilt from its samples.
+    '''
+
+    def __init__(self, directory, kmer, alphabet, min_count, topn=10):
+        self.directory = directory
+        if not os.path.exists(os.path.join(directory, "samples")): os.makedirs(os.path.join(directory, "samples"))
+        self.manifest_file = os.path.join(directory, "store.json")
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file) as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {'k': kmer, 'alphabet': alphabet, 'min_count': min_count, 'topn': topn,
+                             'samples': {}, 'segments': [], 'next_segment': 0,
+                             'total': 0, 'histogram': {}, 'top': [], 'dirty': False}
+            self.save_manifest()
+
+    @property
+    def kmer(self):
+        return self.manifest['k']
+
+    def check(self, kmer, alphabet, min_count):
+        '''None if samples counted with these options can be added, otherwise the reason they cannot'''
+        for name, value in (('k', kmer), ('alphabet', alphabet), ('min_count', min_count)):
+            if self.manifest[name] != value:
+                return "store " + self.directory + " has " + name + " = " + str(self.manifest[name]) + ", not " + str(value)
+        return None
+
+    @contextmanager
+    def locked(self):
+        '''Hold the store for one process at a time; an interrupted add is repaired first'''
+        with open(os.path.join(self.directory, "store.lock"), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.manifest_file) as f:
+                    self.manifest = json.load(f)
+                if self.manifest['dirty']: self.rebuild()
+                yield self
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def save_manifest(self):
+        tmp = self.manifest_file + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f)
+        os.rename(tmp, self.manifest_file)
+
+    def segment_path(self, name, ext):
+        return os.path.join(self.directory, "segment-" + name + ext)
+
+    def sample_path(self, name, ext):
+        return os.path.join(self.directory, "samples", name + ext)
+
+    def add_sample(self, name, prefix, top10, total):
+        '''
+        Add the summary counts of a sample (a save_kmer_vector prefix) and its
+        top 10 frame and total count. A sample added before under the same
+        name is replaced.
+        '''
+        keys = np.load(prefix + ".keys.npy")
+        counts = np.load(prefix + ".counts.npy")
+        if keys.dtype == np.uint64: keys = decode_kmer_bytes(keys, self.kmer)
+
+        self.manifest['dirty'] = True
+        self.save_manifest()
+        replaced = name in self.manifest['samples']
+        if replaced:
+            self.merge_counts(*self.sample_vector(name), sign=-1)
+        np.save(self.sample_path(name, ".keys.npy"), keys)
+        np.save(self.sample_path(name, ".counts.npy"), counts)
+        top10[['Count']].to_csv(self.sample_path(name, "_top10.csv"), index_label='kmer')
+        self.manifest['samples'][name] = {'total': int(total), 'nkmers': len(keys)}
+        self.merge_counts(keys, counts)
+        if replaced: self.manifest['top'] = self.full_top()
+        self.compact()
+        self.manifest['dirty'] = False
+        self.save_manifest()
+
+    def sample_vector(self, name):
+        return np.load(self.sample_path(name, ".keys.npy")), np.load(self.sample_path(name, ".counts.npy"))
+
+    def merge_counts(self, keys, counts, sign=1):
+        '''Add (sign 1) or subtract (-1) sorted, unique (keys, counts) to the cohort totals'''
+        counts = sign * np.asarray(counts, dtype=np.int64)
+        old = np.zeros(len(keys), dtype=np.int64)
+        pending = np.ones(len(keys), dtype=bool)
+        for segment in self.manifest['segments']:
+            if not pending.any(): break
+            skeys = np.load(self.segment_path(segment, ".keys.npy"), mmap_mode='r')
+            idx = np.flatnonzero(pending)
+            pos = np.minimum(np.searchsorted(skeys, keys[idx]), len(skeys) - 1)
+            hit = skeys[pos] == keys[idx]
+            if not hit.any(): continue
+            scounts = np.load(self.segment_path(segment, ".counts.npy"), mmap_mode='r+')
+            idx, pos = idx[hit], pos[hit]
+            old[idx] = scounts[pos]
+            scounts[pos] = old[idx] + counts[idx]
+            scounts.flush()
+            del scounts
+            pending[idx] = False
+
+        if pending.any():
+            #k-mers new to the cohort, still in sorted order
+            segment = "%06d" % self.manifest['next_segment']
+            self.manifest['next_segment'] += 1
+            np.save(self.segment_path(segment, ".keys.npy"), keys[pending])
+            np.save(self.segment_path(segment, ".counts.npy"), counts[pending])
+            self.manifest['segments'].append(segment)
+
+        new = old + counts
+        histogram = Counter(dict((int(c), f) for c, f in self.manifest['histogram'].items()))
+        for values, step in ((old, -1), (new, 1)):
+            values, freqs = np.unique(values[values > 0], return_counts=True)
+            for c, f in zip(values.tolist(), freqs.tolist()): histogram[c] += step * f
+        self.manifest['histogram'] = dict((str(c), f) for c, f in sorted(histogram.items()) if f > 0)
+        self.manifest['total'] += int(counts.sum())
+
+        #counts only grow on an add, so the new top is among the old top and the touched k-mers
+        if sign > 0:
+            top = dict((k, c) for k, c in self.manifest['top'])
+            if top and len(keys):
+                topkeys = np.array(list(top), dtype=keys.dtype)
+                pos = np.minimum(np.searchsorted(keys, topkeys), len(keys) - 1)
+                for k, p, hit in zip(list(top), pos.tolist(), (keys[pos] == topkeys).tolist()):
+                    if hit: top[k] = int(new[p])
+            order = np.argsort(-new, kind='stable')[:self.manifest['topn']]
+            for k, c in zip(keys[order].astype(str).tolist(), new[order].tolist()): top[k] = c
+            self.manifest['top'] = [list(kc) for kc in sorted(top.items(), key=lambda kc: (-kc[1], kc[0]))[:self.manifest['topn']]]
+
+    def full_top(self):
+        '''Top k-mers by scanning every segment, needed when counts went down'''
+        top = []
+        for segment in self.manifest['segments']:
+            skeys = np.load(self.segment_path(segment, ".keys.npy"), mmap_mode='r')
+            scounts = np.load(self.segment_path(segment, ".counts.npy"), mmap_mode='r')
+            n = min(self.manifest['topn'], len(scounts))
+            if not n: continue
+            #every k-mer tied with the n-th count, ties are broken by k-mer below
+            order = np.flatnonzero(scounts >= np.partition(scounts, len(scounts) - n)[len(scounts) - n])
+            top.extend((k, c) for k, c in zip(skeys[order].astype(str).tolist(), scounts[order].tolist()) if c > 0)
+        return [list(kc) for kc in sorted(top, key=lambda kc: (-kc[1], kc[0]))[:self.manifest['topn']]]
+
+    def merge_segments(self, segments):
+        '''Merge segments (disjoint k-mers) into the first one'''
+        keys = np.concatenate([np.load(self.segment_path(s, ".keys.npy")) for s in segments])
+        counts = np.concatenate([np.load(self.segment_path(s, ".counts.npy")) for s in segments])
+        order = np.argsort(keys, kind='stable')
+        np.save(self.segment_path(segments[0], ".keys.tmp.npy"), keys[order])
+        np.save(self.segment_path(segments[0], ".counts.tmp.npy"), counts[order])
+        for ext in (".keys", ".counts"):
+            os.rename(self.segment_path(segments[0], ext + ".tmp.npy"), self.segment_path(segments[0], ext + ".npy"))
+        for s in segments[1:]:
+            for ext in (".keys.npy", ".counts.npy"): os.remove(self.segment_path(s, ext))
+        self.manifest['segments'] = [s for s in self.manifest['segments'] if s not in segments[1:]]
+
+    def compact(self):
+        segments = self.manifest['segments']
+        if len(segments) < 2: return
+        sizes = [len(np.load(self.segment_path(s, ".keys.npy"), mmap_mode='r')) for s in segments]
+        if sum(sizes[1:]) * delta_fraction > sizes[0]: self.merge_segments(segments)
+        elif len(segments) - 1 > max_delta_segments: self.merge_segments(segments[1:])
+
+    def rebuild(self):
+        '''Recount the cohort totals from the samples, e.g. after an interrupted add'''
+        print("Rebuilding the k-mer store " + self.directory + " from its samples")
+        for segment in self.manifest['segments']:
+            for ext in (".keys.npy", ".counts.npy"):
+                if os.path.exists(self.segment_path(segment, ext)): os.remove(self.segment_path(segment, ext))
+        self.manifest.update({'segments': [], 'total': 0, 'histogram': {}, 'top': [], 'dirty': True})
+        for name in sorted(self.manifest['samples']):
+            self.merge_counts(*self.sample_vector(name))
+            self.compact()
+        self.manifest['dirty'] = False
+        self.save_manifest()
+
+    def histogram(self, min_count=1):
+        '''(count, number of k-mers with that count) arrays of the cohort totals'''
+        items = sorted((int(c), f) for c, f in self.manifest['histogram'].items() if int(c) >= min_count)
+        values = np.array([c for c, _ in items], dtype=np.int64)
+        freqs = np.array([f for _, f in items], dtype=np.int64)
+        return values, freqs
+
+    def top(self):
+        '''(k-mer bytes, counts) of the top k-mers of the cohort'''
+        top = self.manifest['top']
+        return (np.array([k for k, _ in top], dtype='S%d' % self.kmer),
+                np.array([c for _, c in top], dtype=np.int64))
+
+    def sample_tops(self):
+        '''{sample: [top 10 frame, total count]} of every sample in the store'''
+        import pandas as pd
+        tops = dict()
+        for name, info in self.manifest['samples'].items():
+            df10 = pd.read_csv(self.sample_path(name, "_top10.csv"), index_col=0, keep_default_na=False)
+            tops[name] = [df10, info['total']]
+        return tops
+
+    def remove(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+"""tables.py: Reading and writing k-mer count tables as CSV, Parquet or NumPy arrays."""
+
+import json
+import numpy as np
+
+from .packed import max_packed_kmer, pack_kmers, decode_kmer_bytes
+
+
+table_formats = ['csv', 'parquet', 'npz']
+table_extensions = {'csv': '.csv', 'parquet': '.parquet', 'npz': '.npz'}
+
+#compression codecs each format accepts, the first one is the default
+table_compressions = {
+    'csv': ['none', 'gzip', 'bz2', 'xz'],
+    'parquet': ['snappy', 'none', 'gzip', 'zstd', 'brotli', 'lz4'],
+    'npz': ['none', 'zip'],
+}
+csv_compression_ext = {'gzip': '.gz', 'bz2': '.bz2', 'xz': '.xz'}
+
+
+def table_metadata(kmer, alphabet, prune_kmer, sample_name):
+    '''Metadata header stored with every binary count table'''
+    from . import __version__
+    return {'k': kmer, 'alphabet': alphabet, 'min_count': prune_kmer,
+            'sample': sample_name, 'mercat_version': __version__}
+
+
+def table_filename(path_base, fmt, compression=None):
+    fn = path_base + table_extensions[fmt]
+    if fmt == 'csv' and compression in csv_compression_ext: fn += csv_compression_ext[compression]
+    return fn
+
+
+def write_count_table(df, path_base, fmt, kmerstring, metadata, compression=None):
+    '''
+    Write a k-mer count table (k-mers as index, Count and property columns)
+    to path_base plus the extension of fmt, returns the file name. CSV is
+    written exactly as before and carries no metadata. Parquet stores the
+    metadata in the schema. NPZ stores nucleotide k-mers (k <= 32, ACGT only)
+    as 2-bit packed uint64 codes and anything else as fixed-width bytes, one
+    array per column, and the metadata as JSON.
+    '''
+    if compression is None: compression = table_compressions[fmt][0]
+    fn = table_filename(path_base, fmt, compression)
+
+    if fmt == 'csv':
+        df.to_csv(fn, index_label=kmerstring, index=True,
+                  compression=None if compression == 'none' else compression)
+
+    elif fmt == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pandas(df.rename_axis(kmerstring), preserve_index=True)
+        schema_metadata = dict(table.schema.metadata or {})
+        schema_metadata[b'mercat'] = json.dumps(metadata).encode('utf-8')
+        table = table.replace_schema_metadata(schema_metadata)
+        pq.write_table(table, fn, compression=None if compression == 'none' else compression)
+
+    elif fmt == 'npz':
+        kmer = metadata['k']
+        kmers = np.asarray(df.index.values.astype('S%d' % kmer)) if len(df) else np.empty(0, dtype='S%d' % kmer)
+        arrays = dict(('column_' + c, df[c].values) for c in df.columns)
+        codes = None
+        if metadata['alphabet'] == 'nucleotide' and kmer <= max_packed_kmer:
+            codes = pack_kmers(kmers, kmer)
+        if codes is not None: arrays['codes'] = codes
+        else: arrays['kmers'] = kmers
+        arrays['metadata'] = np.array(json.dumps(dict(metadata, index_label=kmerstring, columns=list(df.columns))))
+        if compression == 'zip': np.savez_compressed(fn, **arrays)
+        else: np.savez(fn, **arrays)
+
+    else:
+        raise ValueError("unknown table format " + str(fmt))
+
+    return fn
+
+
+class CountTableWriter(object):
+    '''
+    Write a count table piece by piece, for tables that are produced in
+    parts (e.g. bucket by bucket). CSV pieces are appended, Parquet pieces
+    become row groups; NPZ has no append mode, so its pieces are collected
+    and written on close.
+    '''
+
+    def __init__(self, path_base, fmt, kmerstring, metadata, compression=None):
+        self.path_base = path_base
+        self.fmt = fmt
+        self.kmerstring = kmerstring
+        self.metadata = metadata
+        self.compression = compression or table_compressions[fmt][0]
+        self.fn = table_filename(path_base, fmt, self.compression)
+        self.pieces = []
+        self.parquet_writer = None
+        self.started = False
+
+    def append(self, df):
+        if not len(df): return
+        if self.fmt == 'csv':
+            df.to_csv(self.fn, index_label=self.kmerstring, index=True, mode='a' if self.started else 'w',
+                      header=not self.started, compression=None if self.compression == 'none' else self.compression)
+        elif self.fmt == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(df.rename_axis(self.kmerstring), preserve_index=True)
+            if self.parquet_writer is None:
+                schema_metadata = dict(table.schema.metadata or {})
+                schema_metadata[b'mercat'] = json.dumps(self.metadata).encode('utf-8')
+                table = table.replace_schema_metadata(schema_metadata)
+                self.parquet_writer = pq.ParquetWriter(self.fn, table.schema,
+                                                       compression=None if self.compression == 'none' else self.compression)
+            else:
+                table = table.replace_schema_metadata(self.parquet_writer.schema.metadata)
+            self.parquet_writer.write_table(table)
+        else:
+            self.pieces.append(df)
+        self.started = True
+
+    def close(self, empty=None):
+        '''Finish the table; empty is the (column-only) frame written if nothing was appended'''
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+        elif self.fmt == 'npz' and self.pieces:
+            import pandas as pd
+            write_count_table(pd.concat(self.pieces), self.path_base, self.fmt, self.kmerstring,
+                              self.metadata, self.compression)
+        elif not self.started and empty is not None:
+            write_count_table(empty, self.path_base, self.fmt, self.kmerstring, self.metadata, self.compression)
+        self.pieces = []
+        return self.fn
+
+
+def read_count_table(fn):
+    '''Read a table written by write_count_table, returns (DataFrame, metadata or None for CSV)'''
+    import pandas as pd
+    if fn.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        table = pq.read_table(fn)
+        metadata = (table.schema.metadata or {}).get(b'mercat')
+        return table.to_pandas(), (json.loads(metadata) if metadata else None)
+
+    if fn.endswith('.npz'):
+        with np.load(fn) as data:
+            metadata = json.loads(str(data['metadata']))
+            kmer = metadata['k']
+            if 'codes' in data: kmers = decode_kmer_bytes(data['codes'], kmer)
+            else: kmers = data['kmers']
+            df = pd.DataFrame(dict((c, data['column_' + c]) for c in metadata['columns']),
+                              index=pd.Index(kmers.astype(str), dtype=object, name=metadata['index_label']),
+                              columns=metadata['columns'])
+        return df, metadata
+
+    #k-mers such as NAN or NA must not turn into missing values, only empty property cells may
+    columns = ['Count', 'GC_Percent', 'AT_Percent', 'PI', 'MW', 'Hydro']
+    df = pd.read_csv(fn, index_col=0, keep_default_na=False, na_values=dict((c, ['']) for c in columns))
+    return df, None
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+"""tools.py: Running the external tool stages (trimmomatic, prodigal) on input chunks concurrently."""
+
+import io
+import os
+import sys
+import queue
+import shlex
+import signal
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from .seqreader import read_chunks, read_fasta, read_fastq
+
+
+#chunks handed to the external tools: a few per core, but not smaller than this
+min_tool_chunk_bytes = 1 << 20
+
+def tool_chunk_bytes(size, num_cores, max_bytes):
+    '''Chunk size that gives every core about four chunks of the input, capped at max_bytes (-s)'''
+    return int(max(min_tool_chunk_bytes, min(max_bytes, -(-size // (4 * max(num_cores, 1))))))
+
+
+def trimmomatic_command(window):
+    '''trimmomatic SE -phred33 test.fq Out.fastq ILLUMINACLIP:TruSeq2-SE.fa:2:30:10 LEADING:3 TRAILING:3 SLIDINGWINDOW:4:30 MINLEN:50'''
+    return ("trimmomatic SE -phred33 /dev/stdin /dev/stdout ILLUMINACLIP:TruSeq2-SE.fa:2:30:10 LEADING:3 TRAILING:3 "
+            "SLIDINGWINDOW:4:%s MINLEN:50" % window)
+
+
+def prodigal_command(bif):
+    '''prodigal -i test_amino-acid.fa -o output.gff -a output.orf_pro.faa  -f gff -p meta -d output.orf_nuc
+    without -i prodigal reads stdin, the proteins (-a) go to stdout'''
+    return "prodigal -o %s -a /dev/stdout -f gff -p meta -d %s" % (bif + ".gff", bif + "_nuc.ffn")
+
+
+def fastq_to_fasta_command():
+    '''Streaming FASTQ -> FASTA filter (seqreader.fastq_to_fasta), a process of its own in the pipeline'''
+    return shlex.quote(sys.executable) + " -m mercat.seqreader"
+
+
+def tool_env():
+    '''Environment in which the python pipeline stages import this copy of mercat'''
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = root + (os.pathsep + env['PYTHONPATH'] if env.get('PYTHONPATH') else "")
+    return env
+
+
+def tool_output_file(bif, trim_window, gene_calls):
+    '''File the last tool stage of a chunk is saved to: the proteins with -p, the trimmed reads with -t only'''
+    if gene_calls: return bif + ("_trimmed_pro.faa" if trim_window else "_pro.faa")
+    return bif + "_trimmed.fq"
+
+
+def tool_log_file(bif):
+    '''File the stderr of the tools of a chunk goes to'''
+    return bif + "_tools.log"
+
+
+def log_tail(fn, nlines=20):
+    '''Last lines of a tool log, for the error message of a failed tool'''
+    try:
+        with open(fn, errors='replace') as f:
+            return "".join(f.readlines()[-nlines:])
+    except OSError:
+        return ""
+
+
+def tool_pipeline(bif, trim_window, gene_calls):
+    '''Shell pipeline of the tool stages of one chunk, reading stdin and writing stdout'''
+    stages = []
+    if trim_window: stages.append(trimmomatic_command(trim_window))
+    if gene_calls:
+        if trim_window: stages.append(fastq_to_fasta_command())
+        stages.append(prodigal_command(bif))
+    return " | ".join(stages)
+
+
+def feed_stdin(proc, chunks):
+    '''Write bytes chunks to the stdin of proc and close it; a tool that exits early just ends the feed'''
+    try:
+        for buf in chunks:
+            proc.stdin.write(buf)
+    except (BrokenPipeError, ValueError):
+        pass
+    finally:
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def tee_lines(lines, f):
+    for line in lines:
+        f.write(line)
+        yield line
+
+
+def tool_chunk_sequences(inputfile, chunk_range, bif, trim_window, gene_calls, cwd):
+    '''
+    Run trimmomatic (trim_window) and/or prodigal (gene_calls) on a record-aligned
+    range of inputfile and yield the sequences of the last tool's output while it is
+    being written. The stages are one shell pipeline, trimmed reads are converted to
+    FASTA by a filter process on their way into prodigal, so nothing is held in
+    memory or written to disk in between. Only the last output is saved, to
+    tool_output_file, and the tools' stderr to tool_log_file. A tool that
+    exits non-zero raises CalledProcessError (with the end of the log) once
+    its output has been read, and its saved output is removed.
+    '''
+    pipeline = tool_pipeline(bif, trim_window, gene_calls)
+    output_file = tool_output_file(bif, trim_window, gene_calls)
+    with open(tool_log_file(bif), 'wb') as log:
+        #pipefail: the pipeline fails when any of its tools does, not only the last one
+        proc = subprocess.Popen("set -o pipefail; " + pipeline, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=log, shell=True, executable='/bin/bash', cwd=cwd, env=tool_env(),
+                                start_new_session=True)
+    try:
+        feeder = threading.Thread(target=feed_stdin, args=(proc, read_chunks(inputfile, *chunk_range)))
+        feeder.daemon = True
+        feeder.start()
+
+        lines = io.TextIOWrapper(proc.stdout, encoding='utf-8', errors='replace')
+        is_fastq = not gene_calls
+        with open(output_file, 'w') as out:
+            for _, cseq in (read_fastq if is_fastq else read_fasta)(tee_lines(lines, out)):
+                yield cseq
+        if proc.wait() != 0:
+            os.remove(output_file)
+            raise subprocess.CalledProcessError(proc.returncode, pipeline, stderr=log_tail(tool_log_file(bif)))
+    finally:
+        #a consumer that stops early takes the whole pipeline down with it
+        if proc.poll() is None:
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.wait()
+
+
+def tool_stage_sequences(jobs, num_workers, on_done=None, batch_size=256):
+    '''
+    Run tool_chunk_sequences(*job) for every job, num_workers chunks at a time,
+    and yield the sequences of all of them as they arrive (in no particular
+    order). A bounded queue keeps the tools from running far ahead of the
+    k-mer counter that consumes them. on_done(job) is called once the tools of
+    a job have finished successfully and all its sequences are queued; a tool
+    that failed raises its CalledProcessError here.
+    '''
+    results = queue.Queue(maxsize=4 * num_workers)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run(job):
+        if stop.is_set(): return
+        seqs = tool_chunk_sequences(*job)
+        try:
+            batch = []
+            for cseq in seqs:
+                batch.append(cseq)
+                if len(batch) == batch_size:
+                    if not put(batch): return
+                    batch = []
+            if not put(batch): return
+            if on_done is not None: on_done(job)
+            put(None)
+        except Exception as e:
+            put(e)
+        finally:
+            seqs.close()
+
+    pool = ThreadPoolExecutor(max_workers=num_workers)
+    try:
+        for job in jobs: pool.submit(run, job)
+        remaining = len(jobs)
+        while remaining:
+            item = results.get()
+            if item is None: remaining -= 1
+            elif isinstance(item, Exception): raise item
+            else:
+                for cseq in item: yield cseq
+    finally:
+        stop.set()
+        pool.shutdown(wait=True)